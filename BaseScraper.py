@@ -1,10 +1,17 @@
-from seleniumbase import SB
 import random
 random.seed(1)
+import datetime
+import json
 import logging
+import os
 import re
 from typing import Callable
 from DataPipeline import update_record, retrieve_table, flag_delisted, timestamp_update, connect_to_db
+from PageCache import PageCache
+from ParseMonitor import ParseMonitor, ParseQualityError
+from SelectorConfig import load_selectors
+from PriceStats import PriceStats
+from RefreshScheduler import RefreshScheduler, SCORE_COLUMNS
 import settings
 
 logging.basicConfig(level=logging.INFO)
@@ -14,13 +21,26 @@ class _baseScraper():
     def __init__(self, buy_or_rent:str) -> None:
         self.buy_or_rent = self._choose_table(buy_or_rent)
         self.db_name = 'paris_re'
-        self.property_links = [] # list of properties to scrape
         self.cleaned_data_list = [] # list of dictionaries containing cleaned property details
         self.property_features = [] # list of features being scraped: e.g., rooms, bedrooms, size etc.
         self.table_name = '' # sql table name
         self.conn = '' # sql connection
         self.cur = '' # sql cursor
+        self.site = '' # website name, used to key the page cache
+        self.page_cache = PageCache() # on-disk cache of rendered pages
+        self.parse_monitor = ParseMonitor() # tracks per-field fill rates of the cleaned data
+        self.selector_version = None # version of the selector config currently in use
+        self.price_stats = None # running price statistics per zip code, created on first use
     
+    def _open_browser(self):
+        # seleniumbase takes a while to import, so it's only loaded by the commands that need a browser.
+        from seleniumbase import SB
+        return SB(uc=True, headless=settings.headless, demo=settings.demo_mode)
+
+    def _parse_html(self, page_source:str):
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(page_source, 'html.parser')
+
     def _choose_table(self, buy_or_rent:str) -> str:
         # sets instance variable to either 'buy' or 'rent' which later determines the sql table name
         if buy_or_rent not in ('rent', 'buy'):
@@ -51,7 +71,56 @@ class _baseScraper():
     def _print_results(self, results_dict:dict) -> None:
         logger.info("Formatted scraping results:")
         for key, value in results_dict.items():
-            logger.info(f"{key}: {value}")
+            logger.info("%s: %s", key, value) # formatted lazily, only if the log level lets it through
+
+    def _refresh_selectors(self) -> None:
+        ## Overrides the css selectors with those in the selector config. Cheap to call often, the file is only re-read when it changes.
+        version, selectors = load_selectors(self.site, self.buy_or_rent)
+        if not selectors or version == self.selector_version:
+            return
+        for attribute, selector in selectors.items():
+            if hasattr(self, attribute):
+                setattr(self, attribute, selector)
+            else:
+                logger.warning(f"Unknown selector '{attribute}' in selector config, ignoring...")
+        logger.info(f'Using version {version} of the {self.site} selectors...')
+        self.selector_version = version
+
+    def _monitor_parse_quality(self, rows:list) -> None:
+        ## Checks recent fill rates and halts or degrades the run if fields stop being found.
+        self.parse_monitor.record(rows)
+        collapsed = self.parse_monitor.collapsed_fields()
+        if not collapsed:
+            return
+        details = ', '.join(f'{field}: {rate:.0%}' for field, rate in collapsed.items())
+        if settings.parse_monitor_action == 'halt':
+            dump_path = self._dump_batch(rows)
+            logger.error(f'Fill rates collapsed on {self.table_name}, the {len(rows)} unsaved rows of this batch were written to {dump_path}')
+            raise ParseQualityError(f"Fill rates collapsed on {self.table_name} ({details}). The website has likely changed, please check the selectors in {settings.selector_config_path}.")
+        logger.error(f'Fill rates collapsed on {self.table_name} ({details}), reloading selectors and continuing...')
+        self._refresh_selectors()
+        self.parse_monitor.reset()
+
+    def _dump_batch(self, rows:list) -> str:
+        # Writes a batch that won't be saved to a json file, so it can be inspected or loaded once the selectors are fixed.
+        os.makedirs(settings.parse_monitor_dump_dir, exist_ok=True)
+        file_name = f"{self.table_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        dump_path = os.path.join(settings.parse_monitor_dump_dir, file_name)
+        with open(dump_path, 'w') as f:
+            json.dump(rows, f, default=str, indent=1) # default=str covers dates & decimals
+        return dump_path
+
+    def _get_price_stats(self) -> PriceStats:
+        if self.price_stats is None:
+            self.price_stats = PriceStats(self.site, self.buy_or_rent)
+        return self.price_stats
+
+    def _record_price_stats(self, added:list = (), removed:list = ()) -> None:
+        ## Keeps the price_stats summary table in line with the listings table.
+        price_stats = self._get_price_stats()
+        price_stats.remove(removed)
+        price_stats.add([row for row in added if not row.get('removed')]) # delisted properties don't count towards the stats
+        price_stats.flush(self.cur, self.conn)
 
     def _validate_limit(self, url_string:str, page_num:int) -> bool:
         ## If there's only 50 pages and you enter page 100 into the url it will go to page 50
@@ -60,44 +129,62 @@ class _baseScraper():
         url_page_num = url_string[-len(str(page_num)):]
         return url_page_num == str(page_num)
 
-    def _update_row(self, row, cleaned_data:dict):
-        ## If a value has changed, update the record in MySQL
+    def _update_row(self, row, cleaned_data:dict) -> bool:
+        ## If a value has changed, update the record in MySQL. Returns whether anything changed.
         if cleaned_data.get('removed') == True:
             # Don't update all values because they may now be null & I want to preserve the data.
             logger.info(f'removed property found...')
             flag_delisted(self.table_name, row["id"],
                           cur = self.cur, conn = self.conn)
-            return
+            self._record_price_stats(removed = [row])
+            return True
         
+        changed = False
         for column in self.property_features:
             if cleaned_data.get(column) != row[column] and cleaned_data.get(column) is not None: # If a value has changed, update the row.
                 logger.info(f'New value found:\n url:{row["url"]} \nold {column}: {row[column]}\nnew {column}: {cleaned_data.get(column)}')
-                update_record(table_name = self.table_name,
-                              id = row['id'],
-                              property_dict = cleaned_data,
-                              columns = self.property_features,
-                              cur = self.cur, conn = self.conn)
+                changed = True
+        if changed: # the whole row is rewritten, so one update covers every changed column
+            update_record(table_name = self.table_name,
+                          id = row['id'],
+                          property_dict = cleaned_data,
+                          columns = self.property_features,
+                          cur = self.cur, conn = self.conn)
+            self._record_price_stats(added = [cleaned_data], removed = [row])
+        return changed
 
     def update_table(self, exctract_func:Callable, clean_func:Callable) -> None:
-        with SB(uc=True, headless=settings.headless, demo=settings.demo_mode) as sb:
+        with self._open_browser() as sb:
             self.cur, self.conn = connect_to_db()
-            df = retrieve_table(table_name = self.table_name)
+            # only the columns the refresh compares or scores, so a large table stays small in memory
+            columns = list(dict.fromkeys(['id'] + self.property_features + ['updated'] + SCORE_COLUMNS))
+            df = retrieve_table(table_name = self.table_name, columns = columns)
             if len(df):
-                df = df[df['removed'] == 0].sort_values(by=['updated','timestamp'], ascending=True)
+                df = df[df['removed'] == 0]
             else:
                 logger.info(f'{self.table_name} not found or is empty...')
                 return
 
-            for _, row in df.iterrows():
-                property_dict = exctract_func(property_link = None, sb = sb, target_url=row['url'])
+            # Listings that are most likely to have changed are checked first, until the refresh budget is spent.
+            scheduler = RefreshScheduler(df, self.site, self.buy_or_rent)
+            logger.info(f'{len(scheduler)} listings scheduled for refresh...')
+            for row in scheduler:
+                self._refresh_selectors()
+                property_dict = exctract_func(property_link = None, sb = sb, target_url=row['url'], refresh=True) # a cached copy would hide any change
                 if not property_dict: # If a URL is no longer valid and there's no delisted message, mark the property as delisted.
                     flag_delisted(self.table_name, row['id'], self.cur, self.conn)
+                    self._record_price_stats(removed = [row])
+                    changed = True
                 else:
                     cleaned_data = clean_func(property_dict, update=True)
-                    self._update_row(row, cleaned_data)
-                    timestamp_update(table_name = self.table_name,
+                    if not cleaned_data.get('removed'):
+                        # A broken selector turns every value into None, which _update_row skips, so the listing would look unchanged.
+                        self._monitor_parse_quality([cleaned_data])
+                    changed = self._update_row(row, cleaned_data)
+                timestamp_update(table_name = self.table_name,
                                  id = row['id'],
-                                 cur = self.cur, conn = self.conn)
+                                 cur = self.cur, conn = self.conn,
+                                 changed = changed)
                 
                 
 
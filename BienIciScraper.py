@@ -1,22 +1,23 @@
-from seleniumbase import SB
-from seleniumbase.common.exceptions import NoSuchElementException, TimeoutException
-from bs4 import BeautifulSoup
 import random
 random.seed(1)
+import gc
 import logging
+import os
 import re
-from typing import Callable # type hinting functions as inputs
+import socket
+from typing import Callable, Iterator # type hinting functions as inputs
 import settings 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-from DataPipeline import save_to_sql, get_field_as_list, connect_to_db
+from DataPipeline import save_to_sql, get_field_as_list, connect_to_db, enqueue_urls, lease_urls, ack_urls
 import BaseScraper
 
 class _BaseBienIci(BaseScraper._baseScraper):
     def __init__(self, buy_or_rent: str) -> None:
         super().__init__(buy_or_rent)
         self.base_url = "https://www.bienici.com"
+        self.site = 'bienici'
         self.property_features = ['size', 'rooms', 'bedrooms', 'bathrooms', 'floor', 'realtor', 'zip_code', 'url', 'property_id', 'timestamp','removed']
         self.tile_selector = "a.detailedSheetLink"
         self.details_table_selector = 'allDetails'
@@ -30,6 +31,7 @@ class _BaseBienIci(BaseScraper._baseScraper):
         sb: the web browser SB from seleniumbase
         element: a string representing an HTML element (class or id)
         """
+        from seleniumbase.common.exceptions import NoSuchElementException
         try:
             sb.wait_for_element_present(element, timeout=10)
         except NoSuchElementException:
@@ -51,13 +53,20 @@ class _BaseBienIci(BaseScraper._baseScraper):
                 raise ConnectionError(f"Error: Unable to find element '{element}'. Please check proxy settings...")
         return True
 
-    def _populate_property_list(self, page:int, sb:Callable) -> None:
+    def _populate_property_list(self, page:int, sb:Callable) -> tuple:
+        # Returns the property links on the page and the url the browser ended up on, which is used to check whether we've run out of pages.
         target_url = self.base_url + self.url_extension + str(page)
-        sb.get(target_url)
-        if not self._check_driver(target_url, sb, self.tile_selector):
-            return
-        soup = BeautifulSoup(sb.get_page_source(), 'html.parser')
-        self.property_links.extend([link.get('href') for link in soup.select(self.tile_selector)])
+        page_source, current_url = self.page_cache.get(target_url, self.site, 'index')
+        if not page_source:
+            sb.get(target_url)
+            if not self._check_driver(target_url, sb, self.tile_selector):
+                return [], sb.get_current_url()
+            page_source, current_url = sb.get_page_source(), sb.get_current_url()
+            self.page_cache.put(target_url, self.site, 'index', page_source, current_url)
+        soup = self._parse_html(page_source)
+        links = [link.get('href') for link in soup.select(self.tile_selector)]
+        soup.decompose() # only the links are kept, free the tree straight away
+        return links, current_url
 
     def _extract_property_id(self, url:str) -> str:
         # Extracts the unique id from the url between '/' and 'q='
@@ -66,16 +75,6 @@ class _BaseBienIci(BaseScraper._baseScraper):
             return result[0]
         else: return ''
 
-    def _purge_duplicates(self) -> None:
-        # Checks whether property id already exists in SQL & removes from to-scrape list (property_links)
-        existing_property_ids = get_field_as_list(table_name=self.table_name,
-                                                        column_name='property_id',
-                                                          cur = self.cur)
-        initial_len = len(self.property_links)
-        self.property_links = [x for x in self.property_links if self._extract_property_id(x) not in existing_property_ids]
-        new_len = len(self.property_links)
-        logger.info(f"{initial_len - new_len} duplicates removed, proceeding...")
-    
     def _extract_floor_number(self, floor_string:str) -> int:
         # Extracts first number that has an "e" attached to it from string. e.g., "3e étage (sur 6)" would extract 3.
         pattern = r'\b(\d+)e\b'
@@ -85,21 +84,28 @@ class _BaseBienIci(BaseScraper._baseScraper):
         else:
             return None
 
-    def _extract_property_details(self, property_link:str, sb:Callable, target_url=False) -> dict:
+    def _extract_property_details(self, property_link:str, sb:Callable, target_url=False, refresh:bool = False) -> dict:
+        # refresh: always load the live page (used by update_table to look for changes), the page is still cached for later runs
+        from seleniumbase.common.exceptions import TimeoutException
         if not target_url:
             target_url = self.base_url+property_link
         logger.info(f"\n\nStarting next url...\n{target_url}")
 
-        try:
-            sb.get(target_url)
-        except TimeoutException:
-            logger.info('Target url timed out, trying again...')
+        page_source = None
+        if not refresh:
+            page_source, _ = self.page_cache.get(target_url, self.site, 'detail')
+        if not page_source:
+            try:
+                sb.get(target_url)
+            except TimeoutException:
+                logger.info('Target url timed out, trying again...')
 
-        if not self._check_driver(target_url, sb, '.'+self.details_table_selector):
-            return None, None
-        
-        page_source = sb.get_page_source() 
-        soup = BeautifulSoup(page_source, 'html.parser')
+            if not self._check_driver(target_url, sb, '.'+self.details_table_selector):
+                return None
+
+            page_source = sb.get_page_source()
+            self.page_cache.put(target_url, self.site, 'detail', page_source, sb.get_current_url())
+        soup = self._parse_html(page_source)
 
         all_details_div = soup.find('div', class_=self.details_table_selector)
         size = all_details_div.find('div', string=lambda t: 'm²' in t if t else False)
@@ -119,7 +125,7 @@ class _BaseBienIci(BaseScraper._baseScraper):
         removed = soup.find('div', class_=self.section_title_selector)
         removed = removed.get_text(strip=True).replace('’', '') == 'Cette annonce nest plus disponible.' if removed else False # this header explains that the listing is no longer available.
 
-        return {
+        property_dict = {
             'size': size,
             'rooms': rooms,
             'bedrooms': bedrooms,
@@ -129,7 +135,14 @@ class _BaseBienIci(BaseScraper._baseScraper):
             'realtor': realtor,
             'zip_code': zip_code,
             'url': target_url
-        }, soup
+        }
+        property_dict.update(self._extract_price_details(soup))
+        soup.decompose() # only plain strings are returned, so the tree can be freed straight away
+        return property_dict
+
+    def _extract_price_details(self, soup) -> dict:
+        # Overridden by the rent & buy scrapers to extract their price fields from the page.
+        return {}
     
     def _clean_data(self, property_details_dict: dict, update:bool) -> dict:
         zip_code = self._extract_zip_code(property_details_dict.get('zip_code',''))
@@ -143,85 +156,125 @@ class _BaseBienIci(BaseScraper._baseScraper):
                 'realtor': property_details_dict.get('realtor',''),
                 'zip_code': str(zip_code) if zip_code else None,
                 'url':property_details_dict.get('url'),
-                'property_id':self._extract_property_id(property_details_dict.get('url'))
+                'property_id':self._extract_property_id(property_details_dict.get('url')) or None # blank ids would clash on the unique key
             }
         return cleaned_data
     
     def _process_data(self) -> None:
-        query_insert = {
-        'buy':"""
-        price DECIMAL,
-        price_square_mtr DECIMAL
-        """,
-        'rent':"""
-        monthly_rent DECIMAL
-        """}.get(self.buy_or_rent)
-        create_query = f"""
-            CREATE TABLE IF NOT EXISTS {self.table_name}(
-                id int NOT NULL auto_increment,
-                {query_insert},
-                size DECIMAL,
-                rooms DECIMAL,
-                bedrooms DECIMAL,
-                bathrooms DECIMAL,
-                floor INT UNSIGNED,
-                realtor VARCHAR(255),
-                zip_code VARCHAR(255),
-                url VARCHAR(255),
-                property_id VARCHAR(255),
-                timestamp TIMESTAMP,
-                removed BOOLEAN,
-                updated TIMESTAMP,
-                PRIMARY KEY (id)
-            )
-            """
+        self._monitor_parse_quality(self.cleaned_data_list)
 
         # Saves the scraped data in SQL
-        save_to_sql(table_name= self.table_name, 
-                    create_query = create_query,
+        inserted = save_to_sql(table_name= self.table_name, 
                     columns = self.property_features,
                     property_dict_list= self.cleaned_data_list,  
                     uid_column='property_id',
                     cur = self.cur, 
                     conn = self.conn)
+        self._record_price_stats(added = inserted)
         self.cleaned_data_list = [] 
+        gc.collect() # parsed pages contain reference cycles, free them once per batch rather than whenever the collector runs
     
+    def _iter_property_links(self, sb:Callable) -> Iterator[str]:
+        ## Yields the links of new properties one index page at a time, so links are scraped as they're found
+        ## rather than piling up in a list. Properties already in the database are skipped.
+        existing_property_ids = set(get_field_as_list(table_name=self.table_name,
+                                                      column_name='property_id',
+                                                      cur = self.cur))
+        seen_property_ids = set()
+        dup_count = 0
+        keyword = 'sale' if self.buy_or_rent == 'buy' else 'rent'
+        for x in range(1,settings.property_page_limit + 1):
+            logger.info(f"Scraping properties for {keyword} from page {x} of BienIci...")
+            self._refresh_selectors()
+            links, current_url = self._populate_property_list(x, sb)
+            for link in links:
+                property_id = self._extract_property_id(link)
+                if property_id in existing_property_ids or property_id in seen_property_ids:
+                    dup_count += 1
+                    continue
+                seen_property_ids.add(property_id)
+                yield link
+            # Checks whether the current page number is below what is should be, indicating that we've run out of pages to scrape.
+            if not super()._validate_limit(current_url, x):
+                break
+        logger.info(f"{dup_count} duplicates skipped...")
+
     def scrape(self) -> None:
-        with SB(uc=True, headless=settings.headless, demo=settings.demo_mode) as sb:
+        with self._open_browser() as sb:
             self.cur, self.conn = connect_to_db()
-            ## Populate list of property url's
-            for x in range(1,settings.property_page_limit + 1):
-                keyword = 'sale' if self.buy_or_rent == 'buy' else 'rent'
-                logger.info(f"Scraping properties for {keyword} from page {x} of BienIci...")
-                self._populate_property_list(x, sb)
-                current_url = sb.get_current_url()
-                # Checks whether the current page number is below what is should be, indicating that we've run out of pages to scrape.
-                if not super()._validate_limit(current_url, x):
-                    break
-            
-            ## Remove pre-existing properties from property list before commencing scraping
-            self._purge_duplicates()
 
             ## Loop through property urls and extract details of each one
             keyword = 'sale' if self.buy_or_rent == 'buy' else 'rent'
             logger.info(f"Commencing the scraping of properties for {keyword}...")
-            for x in range(len(self.property_links)):
-                property_details_dict = self._extract_property_details(self.property_links[x], sb)
+            for property_link in self._iter_property_links(sb):
+                self._refresh_selectors()
+                property_details_dict = self._extract_property_details(property_link, sb)
+                if not property_details_dict: # dead link, nothing to save
+                    continue
                 self._clean_data(property_details_dict, update = False)
                 if settings.print_results:
                     self._print_results(property_details_dict)
-                ## Save results to database every 5 properties
-                if x % 5 == 0 and x > 0:
+                ## Save results to database once max_rows_in_flight properties have been scraped
+                if len(self.cleaned_data_list) >= settings.max_rows_in_flight:
                     self._process_data()
 
         if self.cleaned_data_list: # if there's any remaining results at the end, insert them into the table
             self._process_data()
 
-        self.property_links = [] # remove properties that have been logged
         logger.info("BienIci scraper finished.")
         self.cur.close()
         self.conn.close()
 
+    def publish(self) -> None:
+        ## Distributed mode, step 1: crawl the index pages and add the new property urls to the shared crawl queue.
+        ## Any number of machines can then run work() to scrape them.
+        added, queued = 0, 0
+        urls = []
+        with self._open_browser() as sb:
+            self.cur, self.conn = connect_to_db()
+            for link in self._iter_property_links(sb):
+                urls.append(self.base_url + link)
+                if len(urls) >= settings.max_rows_in_flight:
+                    added += enqueue_urls(self.site, self.buy_or_rent, urls, self.cur, self.conn)
+                    queued += len(urls)
+                    urls = []
+        added += enqueue_urls(self.site, self.buy_or_rent, urls, self.cur, self.conn)
+        queued += len(urls)
+        logger.info(f"{added} new properties added to the crawl queue ({queued - added} already queued)...")
+        self.cur.close()
+        self.conn.close()
+
+    def work(self, worker_id:str = None) -> None:
+        ## Distributed mode, step 2: lease urls from the crawl queue, scrape them and ack them once saved.
+        ## If a worker dies, its lease expires and another worker picks the urls up. The unique keys on
+        ## property_id & url (plus the duplicate check in save_to_sql) stop a retried url being inserted twice.
+        worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        with self._open_browser() as sb:
+            self.cur, self.conn = connect_to_db()
+            while True:
+                leased = lease_urls(self.site, self.buy_or_rent, worker_id,
+                                    batch_size = settings.queue_batch_size,
+                                    lease_seconds = settings.queue_lease_seconds,
+                                    max_attempts = settings.queue_max_attempts,
+                                    cur = self.cur, conn = self.conn)
+                if not leased:
+                    logger.info(f"Crawl queue is empty, worker {worker_id} finished.")
+                    break
+                logger.info(f"Worker {worker_id} leased {len(leased)} properties...")
+                for _, url in leased:
+                    self._refresh_selectors()
+                    property_details_dict = self._extract_property_details(None, sb, target_url=url)
+                    if not property_details_dict: # dead link, nothing to save
+                        continue
+                    self._clean_data(property_details_dict, update = False)
+                    if settings.print_results:
+                        self._print_results(property_details_dict)
+                if self.cleaned_data_list:
+                    self._process_data()
+                ack_urls([queue_id for queue_id, _ in leased], self.cur, self.conn) # only ack once the data is saved
+        self.cur.close()
+        self.conn.close()
+
 
 class BienIciRent(_BaseBienIci):
     def __init__(self) -> None:
@@ -231,14 +284,10 @@ class BienIciRent(_BaseBienIci):
         self.url_extension = "/recherche/location/paris-75000?page="
         self.table_name = 'bien_ici_rent'
 
-    def _extract_property_details(self, property_link: str, sb: Callable, target_url=False) -> dict:
-        property_dict, soup = super()._extract_property_details(property_link = property_link, sb = sb, target_url = target_url)
-        if not property_dict: # if url is invalid and details can't be extracted, return nothing
-            return {}
+    def _extract_price_details(self, soup) -> dict:
         monthly_rent = soup.find('span', class_=self.monthly_rent_selector)
         monthly_rent = monthly_rent.get_text(strip=True) if monthly_rent else ''
-        property_dict['monthly_rent'] = monthly_rent
-        return property_dict
+        return {'monthly_rent': monthly_rent}
 
     def _clean_data(self, property_details_dict:dict, update:bool) -> dict:
         cleaned_data = super()._clean_data(property_details_dict, update)
@@ -261,17 +310,12 @@ class BienIciBuy(_BaseBienIci):
         self.url_extension = "/recherche/achat/paris-75000?page="
         self.table_name = 'bien_ici_buy'
 
-    def _extract_property_details(self, property_link: str, sb: Callable, target_url=False) -> dict:
-        property_dict, soup = super()._extract_property_details(property_link, sb, target_url)
-        if not property_dict: # if url is invalid and details can't be extracted, return nothing
-            return None
+    def _extract_price_details(self, soup) -> dict:
         price = soup.find(class_=self.price_header_selector)
         price = price.get_text(strip = True) if price else ''
         price_square_mtr = soup.find(class_=self.price_square_mtr_selector)
         price_square_mtr = price_square_mtr.get_text(strip = True) if price_square_mtr else ''
-        property_dict['price'] = price
-        property_dict['price_square_mtr'] = price_square_mtr
-        return property_dict
+        return {'price': price, 'price_square_mtr': price_square_mtr}
 
     def _clean_data(self, property_details_dict: dict, update: bool) -> dict:
         cleaned_data = super()._clean_data(property_details_dict, update)
@@ -1,76 +1,27 @@
 # This script will be responsible for storing the scraped data in the database.
-import mysql.connector
-from dotenv import load_dotenv
-import os
-import pandas as pd
-from sqlalchemy import create_engine
+# The database itself is chosen with settings.storage_backend, see StorageBackends.py.
+# Only the standard library is imported here, the database drivers and pandas are loaded by the backend when first used.
 import logging
-import datetime
+from StorageBackends import get_backend
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Load environment variables from the .env file
-load_dotenv()
-
-host = os.getenv('DB_HOST')
-user = os.getenv('DB_USER')
-password = os.getenv('DB_PASSWORD')
-
 def connect_to_db():
-    logger.info(f'Connecting to database...')
-    conn = mysql.connector.connect(
-        host = host,
-        user = user,
-        password = password,
-    )
-    cur = conn.cursor() ## The cursor is used to execute commands
-
-    try:
-        cur.execute(f'CREATE DATABASE IF NOT EXISTS paris_re')
-    except mysql.connector.Error as err:
-        raise err(f"Cannot connect to SQL database 'paris_re', please check .env settings.")
-
-    conn.database = 'paris_re'
-
-    return cur, conn
+    return get_backend().connect()
 
-def save_to_sql(table_name:str, create_query:str, columns:list, property_dict_list:list, uid_column:str, cur, conn) -> None:
+def save_to_sql(table_name:str, columns:list, property_dict_list:list, uid_column:str, cur, conn) -> list:
     '''
     inputs:
-        table_name: name of table in MySQL,
-        create_query: a query string that will create the SQL table if it doesn't exist
+        table_name: name of table in the database, created by the migrations in Schema.py
         columns: a list containing the columns that will have data entered into them.
         property_dict_list: a list of dictionaries, each containing the info of scraped properties
         uid_column: the column that acts as the unique id for entries
         cur = sql cursor
         conn = sql connection
+    returns the rows that were inserted, i.e. without the duplicates
     '''
-    cur.execute(create_query)
-
-
-    values_placeholder = ', '.join(['%s'] * len(columns))
-    insert_query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({values_placeholder})"
-    dup_count = 0 # Count of duplicate property_id's
-    
-    for data_dict in property_dict_list:
-        data_dict['timestamp'] = datetime.datetime.now()
-        if 'removed' not in data_dict:
-            data_dict['removed'] = False
-        if 'updated' not in data_dict:
-            data_dict['updated'] = None
-            
-        # check if unique id already exists in the table
-        exists = check_duplicate(cur, table_name, uid_column, data_dict[uid_column])
-
-        if not exists: # only insert if unique id isn't already in table
-            data_tuple = tuple(data_dict[col] for col in columns) ## convert dictionary of key:value pairs into tuple of values
-            cur.execute(insert_query, data_tuple)
-        else:
-            dup_count += 1
-    
-    logger.info(f"{dup_count} duplicates removed prior to insertion...") # I need to remove duplicates twice as sometimes the URL changes and they slip through the first check.
-    conn.commit()
+    return get_backend().save_to_sql(table_name, columns, property_dict_list, uid_column, cur, conn)
 
 def check_duplicate(cur, table_name:str, uid_column:str, uid_value:str) -> bool:
     '''
@@ -80,51 +31,69 @@ def check_duplicate(cur, table_name:str, uid_column:str, uid_value:str) -> bool:
         uid_column: name of column containing the unique id
         uid_value: the unique value being checked to see if it's already stored
     '''
-    cur.execute(f"SELECT EXISTS(SELECT * FROM {table_name} WHERE {uid_column} = %s)", (uid_value,))
-    if cur.fetchone()[0]:
-        return True
-    return False
-    
+    return get_backend().check_duplicate(cur, table_name, uid_column, uid_value)
+
 
 #def get_existing_property_ids(table_name:str, cur, conn) -> list:
 def get_field_as_list(table_name:str, column_name:str, cur) -> list:
-    try:
-        cur.execute(f"SELECT {column_name} FROM {table_name}")
-    except mysql.connector.errors.ProgrammingError:
-        logger.info(f"Table '{table_name}' does not exist yet, returning empty list of pre-existing property id's...")
-        return ['']
-    
-    existing_property_ids = [row[0] for row in cur.fetchall()]
-    return existing_property_ids
-
-def retrieve_table(table_name:str) -> pd.DataFrame:
-    logger.info(f'Retrieving table "{table_name}" from paris_re...')
-    engine = create_engine(f"mysql+mysqlconnector://{user}:{password}@{host}/paris_re")
-    query = f'SELECT * FROM {table_name}'
-    df = pd.read_sql(query, engine)
-    return df
+    return get_backend().get_field_as_list(table_name, column_name, cur)
+
+def retrieve_table(table_name:str, columns:list = None) -> 'pandas.DataFrame':
+    # returns the given columns of a table (all of them by default) as a pandas DataFrame
+    return get_backend().retrieve_table(table_name, columns)
+
+def export_table(table_name:str, path:str, cur) -> int:
+    # writes a table to a csv file, returns the number of rows written
+    return get_backend().export_table(table_name, path, cur)
 
 def update_record(table_name, id, property_dict, columns, cur, conn) -> None:
-    # Generate the SET part of the UPDATE query using dictionary keys and placeholders
-    columns = [x for x in columns if x not in ('removed','updated','timestamp')]
-    set_clause = ', '.join([f"{column} = %({column})s" for column in columns])
-    # Update the specific row
-    update_query = f"UPDATE {table_name} SET {set_clause} WHERE id = %(id)s"
-    property_dict['id'] = id # add in id to the property details
-    cur.execute(update_query, property_dict)
-    conn.commit() # Commit the changes
-    logger.info(f'Property {id} in {table_name} updated successfully...')
+    # Updates the given columns of a row with the values in property_dict
+    get_backend().update_record(table_name, id, property_dict, columns, cur, conn)
 
 def flag_delisted(table_name, id, cur, conn) -> None:
     # Flags a property as delisted.
-    update_query = f'UPDATE {table_name} SET removed = TRUE WHERE id = {id}'
-    cur.execute(update_query)
-    conn.commit()
-    logger.info(f'Row with ID {id} in {table_name} flagged as delisted successfully...')
-
-def timestamp_update(table_name, id, cur, conn) -> None:
-    # records the time when the record was last checked for updates.
-    update_query = f'UPDATE {table_name} SET updated = %s where id = %s'
-    cur.execute(update_query, (datetime.datetime.now(), id))
-    conn.commit()
-    logger.info('Property update timestamped...\n')
\ No newline at end of file
+    get_backend().flag_delisted(table_name, id, cur, conn)
+
+def timestamp_update(table_name, id, cur, conn, changed:bool = False) -> None:
+    # records the time when the record was last checked for updates, and whether anything had changed.
+    get_backend().timestamp_update(table_name, id, cur, conn, changed)
+
+def lock_price_stats(site:str, buy_or_rent:str, cur, conn) -> None:
+    # starts the transaction a price stats update runs in, other workers wait until it's committed by save_price_stats
+    get_backend().lock_price_stats(site, buy_or_rent, cur, conn)
+
+def unlock_price_stats(site:str, buy_or_rent:str, cur, conn) -> None:
+    get_backend().unlock_price_stats(site, buy_or_rent, cur, conn)
+
+def load_price_stats(site:str, buy_or_rent:str, cur) -> list:
+    # returns the stored statistics for a site & mode as a list of dictionaries
+    return get_backend().load_price_stats(site, buy_or_rent, cur)
+
+def get_live_rows(table_name:str, columns:list, cur) -> list:
+    # returns the given columns of every listing that hasn't been delisted, as a list of dictionaries
+    return get_backend().get_live_rows(table_name, columns, cur)
+
+def save_price_stats(stats_rows:list, cur, conn) -> None:
+    # replaces the given rows of the price_stats table and commits
+    get_backend().save_price_stats(stats_rows, cur, conn)
+
+def enqueue_urls(site:str, buy_or_rent:str, urls:list, cur, conn) -> int:
+    # adds urls to the shared crawl queue, returns the number that weren't already queued
+    return get_backend().enqueue_urls(site, buy_or_rent, urls, cur, conn)
+
+def lease_urls(site:str, buy_or_rent:str, worker_id:str, batch_size:int, lease_seconds:int, max_attempts:int, cur, conn) -> list:
+    '''
+    inputs:
+        site: name of the website
+        buy_or_rent: 'buy' or 'rent'
+        worker_id: identifies the machine & process holding the lease
+        batch_size: maximum number of urls to lease
+        lease_seconds: how long the urls are reserved before other workers can lease them again
+        max_attempts: urls leased this many times without being acked are given up on
+    returns a list of (queue id, url) tuples
+    '''
+    return get_backend().lease_urls(site, buy_or_rent, worker_id, batch_size, lease_seconds, max_attempts, cur, conn)
+
+def ack_urls(ids:list, cur, conn) -> None:
+    # marks leased urls as done
+    get_backend().ack_urls(ids, cur, conn)
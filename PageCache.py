@@ -0,0 +1,180 @@
+# This script stores rendered pages on disk so they can be re-parsed without hitting the network again.
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import zlib
+import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class PageCache():
+    '''
+    An on-disk cache of rendered html, keyed by site + url.
+    The html itself is stored compressed and content-addressed by its sha256 hash,
+    so identical pages reached through different urls are only stored once.
+    index.sqlite keeps track of which key points to which blob and when it was last used.
+    Each lookup or store only touches its own row, and sqlite's locking lets several scraper processes share one cache.
+    '''
+    EVICT_CHECK_EVERY = 100 # stores between checks of the cache size
+
+    def __init__(self, cache_dir:str = None, bypass:bool = None) -> None:
+        self.cache_dir = cache_dir or settings.page_cache_dir
+        self.bypass = settings.page_cache_bypass if bypass is None else bypass
+        self.ttls = settings.page_cache_ttl # seconds before a page is considered stale, per page type
+        self.max_bytes = settings.page_cache_max_mb * 1024 * 1024
+        self.index_path = os.path.join(self.cache_dir, 'index.sqlite')
+        self.conn = None # opened on first use, so bypassed caches never touch the disk
+        self.puts_since_evict_check = self.EVICT_CHECK_EVERY
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is not None:
+            return self.conn
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # isolation_level=None leaves single statements in autocommit, put() opens its own transaction
+        self.conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+                                key TEXT PRIMARY KEY,
+                                hash TEXT NOT NULL,
+                                page_type TEXT,
+                                final_url TEXT,
+                                stored REAL,
+                                accessed REAL,
+                                size INTEGER)""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_pages_hash ON pages (hash)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_pages_accessed ON pages (accessed)')
+        return self.conn
+
+    def _make_key(self, url:str, site:str) -> str:
+        return f'{site}|{url}'
+
+    def _blob_path(self, content_hash:str) -> str:
+        # blobs are split into sub-directories by the first two characters of the hash to keep directories small
+        return os.path.join(self.cache_dir, 'objects', content_hash[:2], content_hash + '.zlib')
+
+    def get(self, url:str, site:str, page_type:str) -> tuple:
+        '''
+        inputs:
+            url: the url that was requested
+            site: name of the website, e.g. 'bienici' or 'seloger'
+            page_type: 'index' or 'detail', determines how long a page stays fresh
+        returns (html, final_url) if a fresh copy is cached, otherwise (None, None)
+        '''
+        if self.bypass:
+            return None, None
+        conn = self._connect()
+        key = self._make_key(url, site)
+        entry = conn.execute('SELECT hash, final_url, stored FROM pages WHERE key = ?', (key,)).fetchone()
+        if not entry:
+            return None, None
+        content_hash, final_url, stored = entry
+
+        ttl = self.ttls.get(page_type, 0)
+        if not settings.page_cache_replay and time.time() - stored > ttl:
+            return None, None
+
+        try:
+            with open(self._blob_path(content_hash), 'rb') as f:
+                html = zlib.decompress(f.read()).decode('utf-8')
+        except (OSError, zlib.error):
+            logger.info(f'Cached page for {url} is missing or corrupt, fetching again...')
+            conn.execute('DELETE FROM pages WHERE key = ?', (key,))
+            return None, None
+
+        conn.execute('UPDATE pages SET accessed = ? WHERE key = ?', (time.time(), key))
+        logger.info(f'Using cached {page_type} page for {url}')
+        return html, final_url or url
+
+    def put(self, url:str, site:str, page_type:str, html:str, final_url:str = None) -> None:
+        '''
+        inputs:
+            url: the url that was requested
+            site: name of the website
+            page_type: 'index' or 'detail'
+            html: the rendered page source
+            final_url: the url the browser ended up on (e.g. after a redirect)
+        '''
+        if self.bypass or not html:
+            return
+        conn = self._connect()
+        data = html.encode('utf-8')
+        content_hash = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(content_hash)
+        key = self._make_key(url, site)
+
+        # The blob is written inside the transaction, so another process can't delete it as unreferenced before the row pointing to it exists.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                with open(blob_path, 'wb') as f:
+                    f.write(zlib.compress(data))
+            old_entry = conn.execute('SELECT hash FROM pages WHERE key = ?', (key,)).fetchone()
+            now = time.time()
+            conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (key, content_hash, page_type, final_url or url, now, now, os.path.getsize(blob_path)))
+            if old_entry and old_entry[0] != content_hash:
+                # the page changed, so this key no longer references its old blob
+                self._release_blob(old_entry[0])
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+        self.puts_since_evict_check += 1
+        if self.puts_since_evict_check >= self.EVICT_CHECK_EVERY:
+            self.puts_since_evict_check = 0
+            self._evict()
+
+    def _release_blob(self, content_hash:str) -> None:
+        # Deletes a blob once no key in the index references it any more.
+        if self.conn.execute('SELECT 1 FROM pages WHERE hash = ? LIMIT 1', (content_hash,)).fetchone():
+            return
+        try:
+            os.remove(self._blob_path(content_hash))
+        except OSError:
+            pass
+
+    def _total_bytes(self) -> int:
+        # several keys can share a blob, so each blob is only counted once
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM pages GROUP BY hash)').fetchone()[0]
+
+    def _evict(self) -> None:
+        ## Removes the least recently used entries until the blobs on disk fit within max_bytes.
+        ## Several keys can share a blob, so a blob is only deleted once nothing references it.
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            total_bytes = self._total_bytes()
+            evicted = 0
+            if total_bytes > self.max_bytes:
+                for key, content_hash, size in conn.execute('SELECT key, hash, size FROM pages ORDER BY accessed').fetchall():
+                    if total_bytes <= self.max_bytes:
+                        break
+                    conn.execute('DELETE FROM pages WHERE key = ?', (key,))
+                    evicted += 1
+                    if not conn.execute('SELECT 1 FROM pages WHERE hash = ? LIMIT 1', (content_hash,)).fetchone():
+                        total_bytes -= size
+                        self._release_blob(content_hash)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        if evicted:
+            logger.info(f'{evicted} pages evicted from the page cache...')
+
+    def clear(self) -> None:
+        # Deletes every cached page.
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        for (content_hash,) in conn.execute('SELECT DISTINCT hash FROM pages').fetchall():
+            try:
+                os.remove(self._blob_path(content_hash))
+            except OSError:
+                pass
+        conn.execute('DELETE FROM pages')
+        conn.execute('COMMIT')
@@ -0,0 +1,45 @@
+# This script keeps track of how often each field is successfully parsed, to detect when a website changes its layout.
+from collections import deque
+import logging
+import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class ParseQualityError(RuntimeError):
+    # Raised when fill rates collapse, which usually means the website's css classes have changed.
+    pass
+
+class ParseMonitor():
+    '''
+    Keeps a rolling window of the most recent cleaned rows and reports the fields
+    whose fill rate (share of rows where the value isn't None/'') drops below its threshold.
+    '''
+    def __init__(self, thresholds:dict = None, window:int = None, min_rows:int = None) -> None:
+        self.thresholds = settings.parse_monitor_thresholds if thresholds is None else thresholds
+        self.window = window or settings.parse_monitor_window
+        self.min_rows = min_rows or settings.parse_monitor_min_rows
+        self.rows = deque(maxlen=self.window)
+
+    def record(self, rows:list) -> None:
+        # Only the monitored fields are kept, so the window doesn't hold on to entire rows.
+        for row in rows:
+            self.rows.append({field: row.get(field) not in (None, '') for field in self.thresholds if field in row})
+
+    def fill_rates(self) -> dict:
+        counts = {}
+        filled = {}
+        for row in self.rows:
+            for field, is_filled in row.items():
+                counts[field] = counts.get(field, 0) + 1
+                filled[field] = filled.get(field, 0) + is_filled
+        return {field: filled[field] / counts[field] for field in counts}
+
+    def collapsed_fields(self) -> dict:
+        # returns {field: fill rate} for every field below its threshold, once enough rows have been seen.
+        if len(self.rows) < self.min_rows:
+            return {}
+        return {field: rate for field, rate in self.fill_rates().items() if rate < self.thresholds[field]}
+
+    def reset(self) -> None:
+        self.rows.clear()
@@ -0,0 +1,211 @@
+# This script maintains running price statistics per arrondissement so they don't need to be recomputed from the full tables.
+import json
+import math
+import logging
+from DataPipeline import lock_price_stats, unlock_price_stats, load_price_stats, save_price_stats, get_live_rows
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METRICS = {
+    'buy': ['price', 'price_square_mtr'],
+    'rent': ['monthly_rent'],
+}
+
+LISTING_TABLES = {
+    'bienici': {'buy': 'bien_ici_buy', 'rent': 'bien_ici_rent'},
+    'seloger': {'buy': 'seloger_buy', 'rent': 'seloger_rent'},
+}
+
+class QuantileSketch():
+    '''
+    A streaming quantile sketch with a fixed relative accuracy (the approach used by DDSketch).
+    Values are counted in logarithmically sized buckets, so any quantile is returned within
+    relative_accuracy of the true value, and values can be removed as well as added,
+    which lets a listing's old price be swapped for its new one.
+    '''
+    def __init__(self, relative_accuracy:float = 0.01, buckets:dict = None) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = buckets or {} # bucket index: number of values in the bucket
+        self.count = sum(self.buckets.values())
+
+    def _bucket(self, value:float) -> int:
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def add(self, value:float) -> None:
+        if value <= 0: # prices are always positive, anything else is a parsing error
+            return
+        bucket = self._bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def remove(self, value:float) -> bool:
+        # returns whether the value was counted, so callers can keep their own totals in line with the sketch
+        if value <= 0:
+            return False
+        bucket = self._bucket(value)
+        if self.buckets.get(bucket, 0) == 0:
+            return False
+        self.buckets[bucket] -= 1
+        if self.buckets[bucket] == 0:
+            del self.buckets[bucket]
+        self.count -= 1
+        return True
+
+    def quantile(self, q:float) -> float:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                return 2 * self.gamma ** bucket / (self.gamma + 1) # midpoint of the bucket in relative terms
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_json(self) -> str:
+        return json.dumps({'relative_accuracy': self.relative_accuracy, 'buckets': self.buckets})
+
+    @classmethod
+    def from_json(cls, sketch_json:str):
+        data = json.loads(sketch_json)
+        return cls(data['relative_accuracy'], {int(bucket): count for bucket, count in data['buckets'].items()})
+
+
+class PriceStats():
+    '''
+    Running count, mean and quartiles of each price metric for one site and mode ('buy' or 'rent'),
+    grouped by zip code. Listings are added when inserted, swapped when their price changes
+    and removed when delisted, so the stats always describe the live listings.
+    Changes are collected between flushes, then applied to the freshly loaded stats while holding a lock,
+    so workers sharing the database add to each other's stats rather than overwriting them.
+    '''
+    def __init__(self, site:str, buy_or_rent:str) -> None:
+        self.site = site
+        self.buy_or_rent = buy_or_rent
+        self.metrics = METRICS[buy_or_rent]
+        self.table_name = LISTING_TABLES[site][buy_or_rent]
+        self.pending = {} # (zip_code, metric): {'added': [values], 'removed': [values]} since the last flush
+
+    def _new_entry(self) -> dict:
+        return {'n': 0, 'total': 0.0, 'sketch': QuantileSketch()}
+
+    def _load(self, cur) -> dict:
+        # returns the stored stats as {(zip_code, metric): {'n', 'total', 'sketch'}}
+        stats = {}
+        for row in load_price_stats(self.site, self.buy_or_rent, cur):
+            stats[(row['zip_code'], row['metric'])] = {
+                'n': row['n'],
+                'total': row['total'],
+                'sketch': QuantileSketch.from_json(row['sketch']),
+            }
+        return stats
+
+    def _values(self, row) -> list:
+        # returns (zip_code, metric, value) for every usable price in a row
+        zip_code = row.get('zip_code')
+        if not zip_code:
+            return []
+        values = []
+        for metric in self.metrics:
+            value = row.get(metric)
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if not math.isnan(value) and value > 0:
+                values.append((zip_code, metric, value))
+        return values
+
+    def _queue(self, rows:list, change:str) -> None:
+        for row in rows:
+            for zip_code, metric, value in self._values(row):
+                self.pending.setdefault((zip_code, metric), {'added': [], 'removed': []})[change].append(value)
+
+    def add(self, rows:list) -> None:
+        self._queue(rows, 'added')
+
+    def remove(self, rows:list) -> None:
+        self._queue(rows, 'removed')
+
+    def _apply_pending(self, stats:dict) -> None:
+        for key, changes in self.pending.items():
+            entry = stats.setdefault(key, self._new_entry())
+            for value in changes['removed']:
+                # Listings that were never counted (e.g. scraped before the stats existed) aren't in the sketch,
+                # so the count & total only go down when the sketch actually held the value.
+                if entry['sketch'].remove(value):
+                    entry['n'] -= 1
+                    entry['total'] -= value
+            for value in changes['added']:
+                entry['sketch'].add(value)
+                entry['n'] += 1
+                entry['total'] += value
+
+    def _to_stats_rows(self, stats:dict) -> list:
+        stats_rows = []
+        for (zip_code, metric), entry in stats.items():
+            sketch = entry['sketch']
+            stats_rows.append({
+                'site': self.site,
+                'buy_or_rent': self.buy_or_rent,
+                'zip_code': zip_code,
+                'metric': metric,
+                'n': entry['n'],
+                'total': entry['total'],
+                'mean': entry['total'] / entry['n'] if entry['n'] else None,
+                'p25': sketch.quantile(0.25),
+                'median': sketch.quantile(0.5),
+                'p75': sketch.quantile(0.75),
+                'sketch': sketch.to_json(),
+            })
+        return stats_rows
+
+    def stats_from_listings(self, rows:list, empty_keys:list = ()) -> list:
+        '''
+        inputs:
+            rows: the live listings of the listing table, as dictionaries with zip_code & the price metrics
+            empty_keys: (zip_code, metric) keys to write as empty when no listing has them any more
+        returns price_stats rows computed from scratch
+        '''
+        stats = {key: self._new_entry() for key in empty_keys}
+        for row in rows:
+            for zip_code, metric, value in self._values(row):
+                entry = stats.setdefault((zip_code, metric), self._new_entry())
+                entry['sketch'].add(value)
+                entry['n'] += 1
+                entry['total'] += value
+        return self._to_stats_rows(stats)
+
+    def rebuild(self, cur, conn) -> int:
+        '''
+        Recomputes the stats from the live listings in the listing table, replacing what's stored.
+        Listings saved by scrapers running at the same time may be counted twice, so run it while no scraper is running.
+        (Listings scraped before the price_stats table existed are counted when the table is created, see Schema.py.)
+        returns the number of listings counted
+        '''
+        lock_price_stats(self.site, self.buy_or_rent, cur, conn)
+        try:
+            rows = get_live_rows(self.table_name, ['zip_code'] + self.metrics, cur)
+            save_price_stats(self.stats_from_listings(rows, empty_keys = self._load(cur)), cur, conn) # zip codes with no live listings left are emptied
+        finally:
+            unlock_price_stats(self.site, self.buy_or_rent, cur, conn)
+        logger.info(f'Price statistics for {self.site} {self.buy_or_rent} rebuilt from {len(rows)} listings...')
+        return len(rows)
+
+    def flush(self, cur, conn) -> None:
+        # Applies the changes since the last flush to the stored stats and writes the rows they modified.
+        if not self.pending:
+            return
+        lock_price_stats(self.site, self.buy_or_rent, cur, conn)
+        try:
+            stats = self._load(cur) # reloaded every flush, as other workers may have changed the stats since
+            self._apply_pending(stats)
+            stats_rows = self._to_stats_rows({key: stats[key] for key in self.pending})
+            save_price_stats(stats_rows, cur, conn)
+        finally:
+            unlock_price_stats(self.site, self.buy_or_rent, cur, conn)
+        logger.info(f'{len(stats_rows)} price statistics updated for {self.site} {self.buy_or_rent}...')
+        self.pending = {}
@@ -0,0 +1,82 @@
+# This script decides which listings update_table re-checks first, so a limited amount of browser time finds as many changes as possible.
+import heapq
+import time
+import datetime
+import logging
+import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Columns the scores are computed from, besides the price column.
+SCORE_COLUMNS = ['timestamp', 'updated', 'checks', 'change_count']
+
+def _segment_weights(prices, buy_or_rent:str):
+    # prices: a pandas Series, returns the price segment weight of each listing (1.0 when the price is missing)
+    weights = prices * 0 + 1.0
+    assigned = prices.isna()
+    for upper_bound, weight in settings.refresh_segment_weights[buy_or_rent]:
+        in_segment = ~assigned if upper_bound is None else ~assigned & (prices < upper_bound)
+        weights[in_segment] = weight
+        assigned |= in_segment
+    return weights.fillna(1.0)
+
+def score_listings(df, site:str, buy_or_rent:str, now:datetime.datetime):
+    '''
+    The expected value of re-checking each listing in a DataFrame now, computed for all rows at once. Higher is more urgent.
+        change rate: share of past checks that found a price change or delisting (smoothed, so new listings start at 0.5)
+        youth: new listings change more often than ones that have sat on the market for months
+        staleness: a listing checked an hour ago is unlikely to have changed since
+        site & price segment weights: from settings.py
+    returns a numpy array of scores in the order of the DataFrame's rows
+    '''
+    import numpy as np
+    import pandas as pd # already loaded by retrieve_table
+    checks = pd.to_numeric(df['checks'], errors='coerce').fillna(0) if 'checks' in df else 0
+    changes = pd.to_numeric(df['change_count'], errors='coerce').fillna(0) if 'change_count' in df else 0
+    change_rate = (changes + 1) / (checks + 2)
+
+    now = pd.Timestamp(now)
+    listed = pd.to_datetime(df['timestamp'], errors='coerce').fillna(now)
+    last_checked = pd.to_datetime(df['updated'], errors='coerce').fillna(listed)
+    listing_age_days = (now - listed).dt.total_seconds().clip(lower=0) / 86400
+    days_since_check = (now - last_checked).dt.total_seconds().clip(lower=0) / 86400
+
+    youth = 1 + 1 / (1 + listing_age_days / settings.refresh_young_listing_days)
+    staleness = 1 - np.exp(-days_since_check / settings.refresh_staleness_days)
+    price_column = 'price' if buy_or_rent == 'buy' else 'monthly_rent'
+    segment_weights = _segment_weights(pd.to_numeric(df[price_column], errors='coerce'), buy_or_rent)
+    scores = change_rate * youth * staleness * settings.refresh_site_weights.get(site, 1.0) * segment_weights
+    return scores.to_numpy(dtype=float)
+
+
+class RefreshScheduler():
+    '''
+    A max-heap of the listings in a DataFrame ordered by score_listings. Iterating pops the most urgent listing
+    until the heap is empty or the browser time budget (settings.refresh_budget_minutes) is spent.
+    The heap only holds (score, position) pairs, each row is taken from the DataFrame as it's popped.
+    '''
+    def __init__(self, df, site:str, buy_or_rent:str, budget_minutes:float = None) -> None:
+        self.budget_seconds = (settings.refresh_budget_minutes if budget_minutes is None else budget_minutes) * 60
+        self.df = df
+        scores = score_listings(df, site, buy_or_rent, datetime.datetime.now())
+        # heapq is a min-heap, so scores are negated. The position breaks ties.
+        self.heap = [(-score, position) for position, score in enumerate(scores.tolist())]
+        heapq.heapify(self.heap)
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def __iter__(self):
+        import pandas as pd
+        start = time.monotonic()
+        checked = 0
+        while self.heap:
+            if self.budget_seconds and time.monotonic() - start > self.budget_seconds:
+                logger.info(f'Refresh budget spent after {checked} listings, {len(self.heap)} left for the next run...')
+                return
+            score, position = heapq.heappop(self.heap)
+            checked += 1
+            # converted to plain python values like iterrows gives, numpy ints don't bind as integers in sqlite3
+            values = self.df.iloc[[position]].to_numpy(dtype=object)[0]
+            yield pd.Series(values, index=self.df.columns, name=self.df.index[position])
@@ -0,0 +1,292 @@
+# This script manages the structure of the SQL tables through a list of versioned migrations.
+# Each migration is applied once and recorded in the schema_migrations table.
+import logging
+import datetime
+from typing import Callable
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PRICE_COLUMNS = {
+    'bien_ici_buy': 'price',
+    'bien_ici_rent': 'monthly_rent',
+    'seloger_buy': 'price',
+    'seloger_rent': 'monthly_rent',
+}
+
+def _id_column(table_name:str, dialect:str) -> tuple:
+    # returns (queries to run before the create statement, id column definition)
+    if dialect == 'sqlite':
+        return [], 'id INTEGER PRIMARY KEY AUTOINCREMENT'
+    if dialect == 'duckdb':
+        return [f"CREATE SEQUENCE IF NOT EXISTS {table_name}_id_seq"], f"id INTEGER DEFAULT nextval('{table_name}_id_seq') PRIMARY KEY"
+    return [], 'id int NOT NULL auto_increment PRIMARY KEY'
+
+def _create_bienici(table_name:str, price_columns:str, dialect:str) -> list:
+    pre_queries, id_column = _id_column(table_name, dialect)
+    numeric = 'DECIMAL' if dialect == 'mysql' else 'DECIMAL(8,2)' # local databases are new, so they start with exact types
+    floor = 'INT UNSIGNED' if dialect == 'mysql' else 'INTEGER'
+    return pre_queries + [f"""
+        CREATE TABLE IF NOT EXISTS {table_name}(
+            {id_column},
+            {price_columns},
+            size {numeric},
+            rooms {numeric},
+            bedrooms {numeric},
+            bathrooms {numeric},
+            floor {floor},
+            realtor VARCHAR(255),
+            zip_code VARCHAR(255),
+            url VARCHAR(255),
+            property_id VARCHAR(255),
+            timestamp TIMESTAMP,
+            removed BOOLEAN,
+            updated TIMESTAMP
+        )
+        """]
+
+def _create_seloger(table_name:str, price_columns:str, dialect:str) -> list:
+    pre_queries, id_column = _id_column(table_name, dialect)
+    numeric = 'DECIMAL' if dialect == 'mysql' else 'DECIMAL(8,2)'
+    floor = 'INT UNSIGNED' if dialect == 'mysql' else 'INTEGER'
+    return pre_queries + [f"""
+        CREATE TABLE IF NOT EXISTS {table_name}(
+            {id_column},
+            property_type VARCHAR(255),
+            {price_columns},
+            size {numeric},
+            rooms {numeric},
+            bedrooms {numeric},
+            floor {floor},
+            balcony BOOLEAN,
+            elevator BOOLEAN,
+            parking BOOLEAN,
+            zip_code VARCHAR(255),
+            url VARCHAR(255),
+            timestamp TIMESTAMP,
+            removed BOOLEAN,
+            updated TIMESTAMP
+        )
+        """]
+
+def _create_tables(dialect:str) -> list:
+    if dialect == 'mysql':
+        buy_prices, rent_prices = 'price DECIMAL, price_square_mtr DECIMAL', 'monthly_rent DECIMAL'
+    else:
+        buy_prices, rent_prices = 'price DECIMAL(12,2), price_square_mtr DECIMAL(10,2)', 'monthly_rent DECIMAL(10,2)'
+    return (_create_bienici('bien_ici_buy', buy_prices, dialect)
+            + _create_bienici('bien_ici_rent', rent_prices, dialect)
+            + _create_seloger('seloger_buy', buy_prices, dialect)
+            + _create_seloger('seloger_rent', rent_prices, dialect))
+
+def _exact_numeric_types(table_name:str) -> list:
+    # Bare DECIMAL is DECIMAL(10,0) in MySQL, which silently rounds e.g. 27.5 m² to 28.
+    price_columns = {
+        'price': 'DECIMAL(12,2)',
+        'price_square_mtr': 'DECIMAL(10,2)',
+        'monthly_rent': 'DECIMAL(10,2)',
+    }
+    columns = {
+        'size': 'DECIMAL(8,2)',
+        'rooms': 'DECIMAL(4,1)',
+        'bedrooms': 'DECIMAL(4,1)',
+    }
+    if table_name.startswith('bien_ici'):
+        columns['bathrooms'] = 'DECIMAL(4,1)'
+    if PRICE_COLUMNS[table_name] == 'price':
+        columns['price'] = price_columns['price']
+        columns['price_square_mtr'] = price_columns['price_square_mtr']
+    else:
+        columns['monthly_rent'] = price_columns['monthly_rent']
+    return [f"ALTER TABLE {table_name} " + ', '.join(f"MODIFY COLUMN {column} {col_type}" for column, col_type in columns.items())]
+
+def _create_index(index_name:str, table_name:str, columns:str, dialect:str, unique:bool = False) -> str:
+    # sqlite & duckdb can skip existing indexes themselves, MySQL can't, so apply_migrations skips its "duplicate key name" error instead.
+    if_not_exists = '' if dialect == 'mysql' else 'IF NOT EXISTS '
+    return f"CREATE {'UNIQUE ' if unique else ''}INDEX {if_not_exists}{index_name} ON {table_name} ({columns})"
+
+def _uid_columns(table_name:str) -> list:
+    return ['url', 'property_id'] if table_name.startswith('bien_ici') else ['url']
+
+def _unique_keys(table_name:str, dialect:str) -> list:
+    queries = []
+    for column in _uid_columns(table_name):
+        # Blank ids aren't real ids, so they become NULL, which unique indexes allow any number of.
+        queries.append(f"UPDATE {table_name} SET {column} = NULL WHERE {column} = ''")
+        if dialect == 'mysql':
+            # Duplicates slipped through before these keys existed, keep the first copy of each before adding them.
+            # apply_migrations logs how many rows this removes.
+            queries.append(f"""
+                DELETE newer FROM {table_name} newer
+                JOIN {table_name} older ON newer.{column} = older.{column} AND newer.id > older.id
+                WHERE older.{column} <> ''
+                """)
+        queries.append(_create_index(f'uq_{table_name}_{column}', table_name, column, dialect, unique=True))
+    return queries
+
+def _composite_indexes(table_name:str, dialect:str) -> list:
+    if dialect == 'duckdb':
+        # duckdb (before 1.2) runs an update of an indexed column as a delete & insert of the row, which fails on its own primary key.
+        # The refresh updates write these columns, and duckdb's column scans are fast without the indexes.
+        return []
+    price_column = PRICE_COLUMNS[table_name]
+    return [
+        _create_index(f'ix_{table_name}_removed_updated', table_name, 'removed, updated', dialect),
+        _create_index(f'ix_{table_name}_zip_code_{price_column}', table_name, f'zip_code, {price_column}', dialect),
+    ]
+
+def _backfill_price_stats(cur, placeholder:str) -> None:
+    # Counts the listings scraped before the price_stats table existed. Runs as part of the migration,
+    # so it happens once and before any scraper saves (and adds to the stats) with the new schema.
+    from PriceStats import PriceStats, LISTING_TABLES # imported here as PriceStats imports this module through DataPipeline
+    columns = ['site', 'buy_or_rent', 'zip_code', 'metric', 'n', 'total', 'mean', 'p25', 'median', 'p75', 'sketch', 'updated']
+    insert_query = f"INSERT INTO price_stats ({', '.join(columns)}) VALUES ({', '.join([placeholder] * len(columns))})"
+    for site, tables in LISTING_TABLES.items():
+        for buy_or_rent, table_name in tables.items():
+            price_stats = PriceStats(site, buy_or_rent)
+            metric_columns = ['zip_code'] + price_stats.metrics
+            cur.execute(f"SELECT {', '.join(metric_columns)} FROM {table_name} WHERE removed = FALSE OR removed IS NULL")
+            rows = [dict(zip(metric_columns, row)) for row in cur.fetchall()]
+            for stats in price_stats.stats_from_listings(rows):
+                stats['updated'] = datetime.datetime.now()
+                cur.execute(insert_query, tuple(stats[col] for col in columns))
+            if rows:
+                logger.info(f'Price statistics for {site} {buy_or_rent} backfilled from {len(rows)} listings...')
+
+def _create_price_stats(dialect:str) -> list:
+    # Running statistics per site, mode and arrondissement, maintained by PriceStats.py.
+    return ["""
+        CREATE TABLE IF NOT EXISTS price_stats(
+            site VARCHAR(32) NOT NULL,
+            buy_or_rent VARCHAR(8) NOT NULL,
+            zip_code VARCHAR(16) NOT NULL,
+            metric VARCHAR(32) NOT NULL,
+            n INT,
+            total DOUBLE,
+            mean DOUBLE,
+            p25 DOUBLE,
+            median DOUBLE,
+            p75 DOUBLE,
+            sketch TEXT,
+            updated TIMESTAMP,
+            PRIMARY KEY (site, buy_or_rent, zip_code, metric)
+        )
+        """, _backfill_price_stats]
+
+def _create_crawl_queue(dialect:str) -> list:
+    # Listing urls published by the index crawl and leased by the workers, see BienIciScraper.publish/work.
+    pre_queries, id_column = _id_column('crawl_queue', dialect)
+    nullable_timestamp = 'TIMESTAMP NULL' if dialect == 'mysql' else 'TIMESTAMP' # otherwise MySQL may default it to the current time
+    # duckdb gets no lease index, lease_urls updates its columns, see _composite_indexes
+    lease_index = [] if dialect == 'duckdb' else [_create_index('ix_crawl_queue_lease', 'crawl_queue', 'site, buy_or_rent, done, lease_expires', dialect)]
+    return pre_queries + [f"""
+        CREATE TABLE IF NOT EXISTS crawl_queue(
+            {id_column},
+            site VARCHAR(32) NOT NULL,
+            buy_or_rent VARCHAR(8) NOT NULL,
+            url VARCHAR(255) NOT NULL,
+            done BOOLEAN,
+            attempts INT,
+            lease_owner VARCHAR(255),
+            lease_expires {nullable_timestamp},
+            enqueued TIMESTAMP
+        )
+        """,
+        _create_index('uq_crawl_queue_url', 'crawl_queue', 'site, buy_or_rent, url', dialect, unique=True),
+    ] + lease_index
+
+def _refresh_counters(dialect:str) -> list:
+    # Number of times each listing was re-checked and how many of those checks found a change, used by RefreshScheduler.py.
+    queries = []
+    for table_name in PRICE_COLUMNS:
+        alter_queries = [f"ALTER TABLE {table_name} ADD COLUMN {column} INT DEFAULT 0" for column in ('checks', 'change_count')]
+        if dialect != 'duckdb':
+            queries += alter_queries
+            continue
+        # duckdb (before 1.1) refuses to alter a table that has indexes, so the unique keys are dropped and added back afterwards.
+        queries += [f"DROP INDEX IF EXISTS uq_{table_name}_{column}" for column in _uid_columns(table_name)]
+        queries += alter_queries
+        queries += [_create_index(f'uq_{table_name}_{column}', table_name, column, dialect, unique=True) for column in _uid_columns(table_name)]
+    return queries
+
+# (version, description, function returning the queries for a dialect). Append new migrations to the end, never edit applied ones.
+# A query can also be a function taking (cur, placeholder), for steps that need more than sql.
+MIGRATIONS = [
+    (1, 'create listing tables', _create_tables),
+    (2, 'exact numeric types', lambda dialect: [query for table_name in PRICE_COLUMNS for query in _exact_numeric_types(table_name)] if dialect == 'mysql' else []),
+    (3, 'unique keys on property_id and url', lambda dialect: [query for table_name in PRICE_COLUMNS for query in _unique_keys(table_name, dialect)]),
+    (4, 'composite indexes for refresh and price lookups', lambda dialect: [query for table_name in PRICE_COLUMNS for query in _composite_indexes(table_name, dialect)]),
+    (5, 'price statistics summary table', _create_price_stats),
+    (6, 'crawl queue for distributed scraping', _create_crawl_queue),
+    (7, 'refresh counters on listing tables', _refresh_counters),
+]
+
+# MySQL errors raised when a statement was already applied by an earlier, partially failed run of the same migration.
+# MySQL commits after every DDL statement, so a failed migration can leave some of its indexes & columns behind.
+ALREADY_APPLIED_ERRORS = {
+    1060: 'duplicate column name',
+    1061: 'duplicate key name',
+}
+
+def get_schema_version(cur) -> int:
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations(
+            version INT NOT NULL,
+            description VARCHAR(255),
+            applied_at TIMESTAMP,
+            PRIMARY KEY (version)
+        )
+        """)
+    cur.execute("SELECT MAX(version) FROM schema_migrations")
+    version = cur.fetchone()[0]
+    return version or 0
+
+def apply_migrations(cur, conn, dialect:str = 'mysql', placeholder:str = '%s', lock:Callable = None, unlock:Callable = None) -> None:
+    '''
+    inputs:
+        cur: sql cursor
+        conn: sql connection
+        dialect: 'mysql', 'sqlite' or 'duckdb'
+        placeholder: the parameter placeholder used by the database driver
+        lock, unlock: functions taking (cur, conn) that stop other processes migrating at the same time
+    Applies every migration newer than the version recorded in schema_migrations.
+    Each migration is applied while holding the lock, and the version is re-read once it's held,
+    so workers starting together don't apply the same migration twice.
+    '''
+    applied = 0
+    while True:
+        if lock:
+            lock(cur, conn)
+        try:
+            current_version = get_schema_version(cur)
+            pending = [migration for migration in MIGRATIONS if migration[0] > current_version]
+            if not pending:
+                break
+            _apply_migration(cur, conn, dialect, placeholder, *pending[0])
+            applied += 1
+        finally:
+            if unlock:
+                unlock(cur, conn)
+    if applied:
+        logger.info(f'Database schema migrated to version {current_version}...')
+    else:
+        logger.info(f'Database schema is up to date (version {current_version})...')
+
+def _apply_migration(cur, conn, dialect:str, placeholder:str, version:int, description:str, get_queries:Callable) -> None:
+    logger.info(f'Applying migration {version}: {description}...')
+    for query in get_queries(dialect):
+        if callable(query):
+            query(cur, placeholder)
+            continue
+        try:
+            cur.execute(query)
+        except Exception as err:
+            if getattr(err, 'errno', None) not in ALREADY_APPLIED_ERRORS:
+                raise
+            logger.info(f'Skipping a statement of migration {version} that was already applied ({ALREADY_APPLIED_ERRORS[err.errno]})...')
+            continue
+        if query.lstrip().startswith('DELETE') and cur.rowcount:
+            logger.warning(f'Migration {version} removed {cur.rowcount} duplicate rows...')
+    cur.execute(f"INSERT INTO schema_migrations (version, description, applied_at) VALUES ({placeholder}, {placeholder}, {placeholder})",
+                (version, description, datetime.datetime.now()))
+    conn.commit()
@@ -0,0 +1,55 @@
+# This script loads the css selectors from an external json file so they can be fixed without changing the code.
+import json
+import logging
+import os
+import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_loaded = {} # path: (modified time, parsed config), so the file is only re-read when it changes
+_missing = set() # paths already reported as missing, the selectors are reloaded for every page so the warning is only logged once
+
+def _resolve(path:str) -> str:
+    # Relative paths are relative to the repository rather than the working directory, so the scraper can be run from anywhere.
+    return path if os.path.isabs(path) else os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+def _read_config(path:str) -> dict:
+    path = _resolve(path)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        if path not in _missing:
+            logger.warning(f"Selector config '{path}' not found, using built-in selectors...")
+            _missing.add(path)
+        return {}
+    _missing.discard(path)
+
+    cached = _loaded.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except ValueError as err:
+        # Keep using the last good version rather than crashing mid-run on a typo.
+        logger.error(f"Selector config '{path}' is not valid json ({err}), keeping previous selectors...")
+        return cached[1] if cached else {}
+
+    _loaded[path] = (mtime, config)
+    return config
+
+def load_selectors(site:str, buy_or_rent:str, path:str = None) -> tuple:
+    '''
+    inputs:
+        site: name of the website, e.g. 'bienici' or 'seloger'
+        buy_or_rent: 'buy' or 'rent'
+        path: location of the json file, defaults to settings.selector_config_path
+    returns (version, selectors) where selectors maps attribute names to css selectors
+    '''
+    config = _read_config(path or settings.selector_config_path)
+    site_config = config.get(site, {})
+    selectors = dict(site_config.get('common', {}))
+    selectors.update(site_config.get(buy_or_rent, {}))
+    return config.get('version'), selectors
@@ -0,0 +1,397 @@
+# This script contains the databases the scraped data can be stored in.
+# The backend is chosen with settings.storage_backend, DataPipeline forwards its functions to it.
+import logging
+import datetime
+import os
+import settings
+from Schema import apply_migrations
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class _baseBackend():
+    '''
+    Generic SQL shared by every backend. Subclasses set the placeholder style and
+    the errors raised when a table doesn't exist, and implement connect/retrieve_table.
+    '''
+    dialect = ''
+    placeholder = '?'
+    missing_table_errors = ()
+    integrity_errors = () # raised when an insert breaks a unique key
+
+    def __init__(self) -> None:
+        self.migrated = False # whether the schema migrations have been applied during this run
+
+    def connect(self) -> tuple:
+        raise NotImplementedError
+
+    def retrieve_table(self, table_name:str, columns:list = None):
+        raise NotImplementedError
+
+    def _select_columns(self, columns:list) -> str:
+        return ', '.join(columns) if columns else '*'
+
+    def begin(self, conn) -> None:
+        # sqlite3 and mysql.connector open a transaction implicitly before the first write.
+        pass
+
+    def begin_exclusive(self, conn) -> None:
+        # Starts a transaction for a read followed by a write that other workers mustn't interleave with,
+        # e.g. leasing queue entries, so two workers can't lease the same url.
+        self.begin(conn)
+
+    def commit(self, conn) -> None:
+        conn.commit()
+
+    def _migrate(self, cur, conn) -> None:
+        if not self.migrated: # only check the schema once per run rather than on every connection
+            apply_migrations(cur, conn, dialect=self.dialect, placeholder=self.placeholder,
+                             lock=self.lock_migrations, unlock=self.unlock_migrations)
+            self.migrated = True
+
+    def lock_migrations(self, cur, conn) -> None:
+        # Held while a migration is applied, so workers starting against an outdated schema apply it one at a time.
+        # Nothing is needed for duckdb, as only one process can open a duckdb file for writing.
+        pass
+
+    def unlock_migrations(self, cur, conn) -> None:
+        pass
+
+    def save_to_sql(self, table_name:str, columns:list, property_dict_list:list, uid_column:str, cur, conn) -> list:
+        values_placeholder = ', '.join([self.placeholder] * len(columns))
+        insert_query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({values_placeholder})"
+        dup_count = 0 # Count of duplicate property_id's
+        inserted = [] # rows that weren't already in the table
+
+        self.begin(conn)
+        for data_dict in property_dict_list:
+            data_dict['timestamp'] = datetime.datetime.now()
+            if 'removed' not in data_dict:
+                data_dict['removed'] = False
+            if 'updated' not in data_dict:
+                data_dict['updated'] = None
+
+            # check if unique id already exists in the table
+            exists = self.check_duplicate(cur, table_name, uid_column, data_dict[uid_column])
+
+            if not exists: # only insert if unique id isn't already in table
+                data_tuple = tuple(data_dict[col] for col in columns) ## convert dictionary of key:value pairs into tuple of values
+                try:
+                    cur.execute(insert_query, data_tuple)
+                except self.integrity_errors:
+                    # Another worker inserted the same property since the check, e.g. after its lease on the url expired.
+                    # Only the failed statement is rolled back, the rest of the batch is still saved.
+                    dup_count += 1
+                    continue
+                inserted.append(data_dict)
+            else:
+                dup_count += 1
+
+        logger.info(f"{dup_count} duplicates removed prior to insertion...") # I need to remove duplicates twice as sometimes the URL changes and they slip through the first check.
+        self.commit(conn) # the whole batch is written in a single transaction
+        return inserted
+
+    def check_duplicate(self, cur, table_name:str, uid_column:str, uid_value:str) -> bool:
+        cur.execute(f"SELECT EXISTS(SELECT 1 FROM {table_name} WHERE {uid_column} = {self.placeholder})", (uid_value,))
+        if cur.fetchone()[0]:
+            return True
+        return False
+
+    def get_field_as_list(self, table_name:str, column_name:str, cur) -> list:
+        try:
+            cur.execute(f"SELECT {column_name} FROM {table_name}")
+        except self.missing_table_errors:
+            logger.info(f"Table '{table_name}' does not exist yet, returning empty list of pre-existing property id's...")
+            return ['']
+        return [row[0] for row in cur.fetchall()]
+
+    def update_record(self, table_name:str, id:int, property_dict:dict, columns:list, cur, conn) -> None:
+        # url & property_id identify the row and never change, rewriting them makes duckdb re-check its unique indexes, which can raise false duplicate key errors.
+        columns = [x for x in columns if x not in ('removed','updated','timestamp','url','property_id')]
+        set_clause = ', '.join([f"{column} = {self.placeholder}" for column in columns])
+        update_query = f"UPDATE {table_name} SET {set_clause} WHERE id = {self.placeholder}"
+        property_dict['id'] = id # add in id to the property details
+        cur.execute(update_query, tuple(property_dict.get(column) for column in columns) + (id,))
+        self.commit(conn)
+        logger.info(f'Property {id} in {table_name} updated successfully...')
+
+    def flag_delisted(self, table_name:str, id:int, cur, conn) -> None:
+        cur.execute(f'UPDATE {table_name} SET removed = TRUE WHERE id = {self.placeholder}', (id,))
+        self.commit(conn)
+        logger.info(f'Row with ID {id} in {table_name} flagged as delisted successfully...')
+
+    def timestamp_update(self, table_name:str, id:int, cur, conn, changed:bool = False) -> None:
+        # Also counts the check, and whether it found a change, for the refresh scheduler.
+        cur.execute(f'''UPDATE {table_name} SET updated = {self.placeholder},
+                        checks = COALESCE(checks, 0) + 1, change_count = COALESCE(change_count, 0) + {self.placeholder}
+                        where id = {self.placeholder}''', (datetime.datetime.now(), int(changed), id))
+        self.commit(conn)
+        logger.info('Property update timestamped...\n')
+
+    def lock_price_stats(self, site:str, buy_or_rent:str, cur, conn) -> None:
+        # Starts the transaction a price stats flush reads & writes in, so workers apply their changes one at a time.
+        self.begin_exclusive(conn)
+
+    def unlock_price_stats(self, site:str, buy_or_rent:str, cur, conn) -> None:
+        # The lock ends with the transaction committed by save_price_stats.
+        pass
+
+    def load_price_stats(self, site:str, buy_or_rent:str, cur) -> list:
+        cur.execute(f"SELECT zip_code, metric, n, total, sketch FROM price_stats WHERE site = {self.placeholder} AND buy_or_rent = {self.placeholder}",
+                    (site, buy_or_rent))
+        return [dict(zip(('zip_code', 'metric', 'n', 'total', 'sketch'), row)) for row in cur.fetchall()]
+
+    def get_live_rows(self, table_name:str, columns:list, cur) -> list:
+        try:
+            cur.execute(f"SELECT {', '.join(columns)} FROM {table_name} WHERE removed = FALSE OR removed IS NULL")
+        except self.missing_table_errors:
+            return []
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def save_price_stats(self, stats_rows:list, cur, conn) -> None:
+        # Update or insert rather than an upsert, as the upsert syntax differs between databases. Deleting & re-inserting
+        # the row instead would trip the primary key in duckdb before 1.2, which checks it before the delete is applied.
+        # Runs in, and commits, the transaction started by lock_price_stats.
+        key_columns = ['site', 'buy_or_rent', 'zip_code', 'metric']
+        value_columns = ['n', 'total', 'mean', 'p25', 'median', 'p75', 'sketch', 'updated']
+        key_clause = ' AND '.join(f"{column} = {self.placeholder}" for column in key_columns)
+        exists_query = f"SELECT EXISTS(SELECT 1 FROM price_stats WHERE {key_clause})"
+        update_query = f"UPDATE price_stats SET {', '.join(f'{column} = {self.placeholder}' for column in value_columns)} WHERE {key_clause}"
+        insert_query = f"INSERT INTO price_stats ({', '.join(key_columns + value_columns)}) VALUES ({', '.join([self.placeholder] * len(key_columns + value_columns))})"
+        for stats in stats_rows:
+            stats['updated'] = datetime.datetime.now()
+            key = tuple(stats[col] for col in key_columns)
+            cur.execute(exists_query, key)
+            if cur.fetchone()[0]:
+                cur.execute(update_query, tuple(stats[col] for col in value_columns) + key)
+            else:
+                cur.execute(insert_query, key + tuple(stats[col] for col in value_columns))
+        self.commit(conn)
+
+    def export_table(self, table_name:str, path:str, cur) -> int:
+        # Writes a table to a csv file without going through pandas. Returns the number of rows written.
+        import csv
+        cur.execute(f"SELECT * FROM {table_name}")
+        row_count = 0
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow([column[0] for column in cur.description])
+            for row in cur.fetchall():
+                writer.writerow(row)
+                row_count += 1
+        return row_count
+
+    def enqueue_urls(self, site:str, buy_or_rent:str, urls:list, cur, conn) -> int:
+        # Adds urls to the crawl queue, skipping any that were already queued. Returns the number added.
+        exists_query = f"SELECT EXISTS(SELECT 1 FROM crawl_queue WHERE site = {self.placeholder} AND buy_or_rent = {self.placeholder} AND url = {self.placeholder})"
+        insert_query = f"INSERT INTO crawl_queue (site, buy_or_rent, url, done, attempts, enqueued) VALUES ({', '.join([self.placeholder] * 6)})"
+        added = 0
+        self.begin(conn)
+        for url in urls:
+            cur.execute(exists_query, (site, buy_or_rent, url))
+            if cur.fetchone()[0]:
+                continue
+            cur.execute(insert_query, (site, buy_or_rent, url, False, 0, datetime.datetime.now()))
+            added += 1
+        self.commit(conn)
+        return added
+
+    def _select_leasable(self, cur, site:str, buy_or_rent:str, batch_size:int, max_attempts:int) -> list:
+        cur.execute(f"""
+            SELECT id, url FROM crawl_queue
+            WHERE site = {self.placeholder} AND buy_or_rent = {self.placeholder} AND done = FALSE AND attempts < {self.placeholder}
+            AND (lease_expires IS NULL OR lease_expires < {self.placeholder})
+            ORDER BY id LIMIT {int(batch_size)}
+            """, (site, buy_or_rent, max_attempts, datetime.datetime.now()))
+        return cur.fetchall()
+
+    def lease_urls(self, site:str, buy_or_rent:str, worker_id:str, batch_size:int, lease_seconds:int, max_attempts:int, cur, conn) -> list:
+        '''
+        Leases up to batch_size urls that aren't done, leased by another worker, or out of attempts.
+        If the worker doesn't ack them before the lease expires they become available again.
+        returns a list of (id, url) tuples
+        '''
+        self.begin_exclusive(conn)
+        rows = self._select_leasable(cur, site, buy_or_rent, batch_size, max_attempts)
+        if rows:
+            ids = [row[0] for row in rows]
+            lease_expires = datetime.datetime.now() + datetime.timedelta(seconds=lease_seconds)
+            cur.execute(f"UPDATE crawl_queue SET lease_owner = {self.placeholder}, lease_expires = {self.placeholder}, attempts = attempts + 1 WHERE id IN ({', '.join([self.placeholder] * len(ids))})",
+                        (worker_id, lease_expires, *ids))
+        self.commit(conn)
+        return [(row[0], row[1]) for row in rows]
+
+    def ack_urls(self, ids:list, cur, conn) -> None:
+        # Marks leased urls as done once their data has been saved.
+        if not ids:
+            return
+        cur.execute(f"UPDATE crawl_queue SET done = TRUE, lease_expires = NULL WHERE id IN ({', '.join([self.placeholder] * len(ids))})", tuple(ids))
+        self.commit(conn)
+
+
+class MySQLBackend(_baseBackend):
+    dialect = 'mysql'
+    placeholder = '%s'
+
+    def __init__(self) -> None:
+        super().__init__()
+        import mysql.connector
+        from dotenv import load_dotenv
+        load_dotenv() # Load the MySQL credentials from the .env file
+        self.mysql = mysql.connector
+        self.missing_table_errors = (mysql.connector.errors.ProgrammingError,)
+        self.integrity_errors = (mysql.connector.errors.IntegrityError,)
+        self.host = os.getenv('DB_HOST')
+        self.user = os.getenv('DB_USER')
+        self.password = os.getenv('DB_PASSWORD')
+
+    def connect(self) -> tuple:
+        logger.info(f'Connecting to database...')
+        conn = self.mysql.connect(
+            host = self.host,
+            user = self.user,
+            password = self.password,
+        )
+        cur = conn.cursor() ## The cursor is used to execute commands
+
+        try:
+            cur.execute(f'CREATE DATABASE IF NOT EXISTS paris_re')
+        except self.mysql.Error as err:
+            raise ConnectionError(f"Cannot connect to SQL database 'paris_re', please check .env settings.") from err
+
+        conn.database = 'paris_re'
+        self._migrate(cur, conn)
+        return cur, conn
+
+    def _select_leasable(self, cur, site:str, buy_or_rent:str, batch_size:int, max_attempts:int) -> list:
+        # SKIP LOCKED lets workers on other machines lease different rows at the same time instead of waiting on each other.
+        cur.execute(f"""
+            SELECT id, url FROM crawl_queue
+            WHERE site = %s AND buy_or_rent = %s AND done = FALSE AND attempts < %s
+            AND (lease_expires IS NULL OR lease_expires < %s)
+            ORDER BY id LIMIT {int(batch_size)}
+            FOR UPDATE SKIP LOCKED
+            """, (site, buy_or_rent, max_attempts, datetime.datetime.now()))
+        return cur.fetchall()
+
+    def lock_migrations(self, cur, conn) -> None:
+        # MySQL commits after every DDL statement, so a transaction can't hold other workers off, a named lock is used instead.
+        cur.execute("SELECT GET_LOCK('paris_re_migrations', %s)", (settings.migration_lock_seconds,))
+        if cur.fetchone()[0] != 1:
+            raise TimeoutError('Timed out waiting for another worker to finish migrating the database schema.')
+
+    def unlock_migrations(self, cur, conn) -> None:
+        cur.execute("SELECT RELEASE_LOCK('paris_re_migrations')")
+        cur.fetchone()
+
+    def lock_price_stats(self, site:str, buy_or_rent:str, cur, conn) -> None:
+        # A named lock rather than SELECT ... FOR UPDATE, which wouldn't stop two workers inserting the first row for a zip code at the same time.
+        cur.execute("SELECT GET_LOCK(%s, %s)", (f'paris_re_price_stats_{site}_{buy_or_rent}', settings.price_stats_lock_seconds))
+        if cur.fetchone()[0] != 1:
+            raise TimeoutError(f'Timed out waiting for another worker to finish updating the {site} {buy_or_rent} price statistics.')
+
+    def unlock_price_stats(self, site:str, buy_or_rent:str, cur, conn) -> None:
+        cur.execute("SELECT RELEASE_LOCK(%s)", (f'paris_re_price_stats_{site}_{buy_or_rent}',))
+        cur.fetchone()
+
+    def retrieve_table(self, table_name:str, columns:list = None):
+        import pandas as pd
+        from sqlalchemy import create_engine
+        logger.info(f'Retrieving table "{table_name}" from paris_re...')
+        engine = create_engine(f"mysql+mysqlconnector://{self.user}:{self.password}@{self.host}/paris_re")
+        return pd.read_sql(f'SELECT {self._select_columns(columns)} FROM {table_name}', engine)
+
+
+class SQLiteBackend(_baseBackend):
+    # Uses the sqlite3 module from the standard library, no server or extra packages required.
+    dialect = 'sqlite'
+    placeholder = '?'
+
+    def __init__(self, path:str = None) -> None:
+        super().__init__()
+        import sqlite3
+        self.sqlite3 = sqlite3
+        self.path = path or settings.sqlite_path
+        self.missing_table_errors = (sqlite3.OperationalError,)
+        self.integrity_errors = (sqlite3.IntegrityError,)
+
+    def connect(self) -> tuple:
+        logger.info(f'Connecting to SQLite database {self.path}...')
+        conn = self.sqlite3.connect(self.path, detect_types=self.sqlite3.PARSE_DECLTYPES)
+        # WAL lets readers (e.g. retrieve_table) run alongside the scraper's writes.
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        cur = conn.cursor()
+        self._migrate(cur, conn)
+        return cur, conn
+
+    def begin_exclusive(self, conn) -> None:
+        # Takes the write lock before selecting, so worker processes sharing the file don't read the same rows to update.
+        conn.execute('BEGIN IMMEDIATE')
+
+    def lock_migrations(self, cur, conn) -> None:
+        # sqlite's ddl is transactional, so the write lock covers the whole migration and is released by its commit.
+        self.begin_exclusive(conn)
+
+    def unlock_migrations(self, cur, conn) -> None:
+        conn.commit() # ends the transaction when there was nothing to migrate
+
+    def retrieve_table(self, table_name:str, columns:list = None):
+        import pandas as pd
+        logger.info(f'Retrieving table "{table_name}" from {self.path}...')
+        conn = self.sqlite3.connect(self.path, detect_types=self.sqlite3.PARSE_DECLTYPES)
+        try:
+            return pd.read_sql(f'SELECT {self._select_columns(columns)} FROM {table_name}', conn)
+        finally:
+            conn.close()
+
+
+class DuckDBBackend(_baseBackend):
+    # Columnar storage, useful for analytical reads and local benchmarking.
+    dialect = 'duckdb'
+    placeholder = '?'
+
+    def __init__(self, path:str = None) -> None:
+        super().__init__()
+        import duckdb
+        self.duckdb = duckdb
+        self.path = path or settings.duckdb_path
+        self.missing_table_errors = (duckdb.CatalogException,)
+        # integrity_errors is left empty: a failed statement aborts the whole duckdb transaction, so it can't be skipped,
+        # and only one process can write to a duckdb file, so workers can't race each other to insert a property.
+
+    def connect(self) -> tuple:
+        logger.info(f'Connecting to DuckDB database {self.path}...')
+        conn = self.duckdb.connect(self.path)
+        self._migrate(conn, conn)
+        return conn, conn # duckdb connections execute queries directly, so the connection doubles as the cursor
+
+    def begin(self, conn) -> None:
+        # duckdb runs in autocommit mode, so batches need an explicit transaction.
+        conn.begin()
+
+    def retrieve_table(self, table_name:str, columns:list = None):
+        logger.info(f'Retrieving table "{table_name}" from {self.path}...')
+        conn = self.duckdb.connect(self.path) # same configuration as the scraper's connection, so both can be open at once
+        try:
+            return conn.execute(f'SELECT {self._select_columns(columns)} FROM {table_name}').df()
+        finally:
+            conn.close()
+
+
+BACKENDS = {
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend,
+    'duckdb': DuckDBBackend,
+}
+
+_backend = None
+
+def get_backend() -> _baseBackend:
+    # Creates the backend chosen in settings.py the first time it's needed.
+    global _backend
+    if _backend is None:
+        if settings.storage_backend not in BACKENDS:
+            raise ValueError(f"Invalid storage_backend '{settings.storage_backend}'. Please choose one of {', '.join(BACKENDS)}")
+        _backend = BACKENDS[settings.storage_backend]()
+    return _backend
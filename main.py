@@ -1,5 +1,5 @@
-from BienIciScraper import BienIciBuy, BienIciRent
-from SelogerScraper import SelogerBuy, SelogerRent
+import argparse
+import logging
 
 """
 before running the script, please ensure your .env file is set up with your mysql details. For example:
@@ -14,26 +14,70 @@ If the script fails to scrape it's likely one of two things:
 
 If you can access the website manually, it's likely the first reason. 
 You can validate this by inspecting the webpage and searching for the missing element.
+
+Usage:
+    python main.py scrape bienici buy
+    python main.py update bienici rent
+    python main.py publish bienici buy # distributed mode, run once
+    python main.py work bienici buy # distributed mode, run on every machine
+    python main.py stats price_stats.csv
+    python main.py rebuild-stats # recompute price_stats from the listing tables
+
+The scrapers (and with them seleniumbase, BeautifulSoup & pandas) are only imported by the commands that use them,
+so commands that don't need a browser, like stats, start quickly. Run startup_benchmark.py to check the import times.
 """
 
-if __name__ == '__main__':
-    # Seloger
-    # seloger_rent = SelogerRent()
-    # seloger_rent.scrape()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-    # seloger_buy = SelogerBuy()
-    # seloger_buy.scrape()
+def get_scraper(site:str, buy_or_rent:str):
+    # Imports the scraper module only once a browser command has been chosen.
+    if site == 'bienici':
+        from BienIciScraper import BienIciBuy, BienIciRent
+        return BienIciBuy() if buy_or_rent == 'buy' else BienIciRent()
+    from SelogerScraper import SelogerBuy, SelogerRent
+    return SelogerBuy() if buy_or_rent == 'buy' else SelogerRent()
 
+def export_stats(path:str) -> None:
+    from DataPipeline import connect_to_db, export_table
+    cur, conn = connect_to_db()
+    row_count = export_table('price_stats', path, cur)
+    logger.info(f'{row_count} rows of price statistics written to {path}')
+    conn.close()
 
-    ## BienIci
-    # bienici_buy = BienIciBuy()
-    # bienici_buy.scrape()
-    # bienici_buy.update_table()
+def rebuild_stats() -> None:
+    from DataPipeline import connect_to_db
+    from PriceStats import PriceStats, LISTING_TABLES
+    cur, conn = connect_to_db()
+    for site, tables in LISTING_TABLES.items():
+        for buy_or_rent in tables:
+            PriceStats(site, buy_or_rent).rebuild(cur, conn)
+    conn.close()
 
-    # bienici_rent = BienIciRent()
-    # bienici_rent.scrape()
-    # bienici_rent.update_table()
-    pass
+def parse_args(argv:list = None):
+    parser = argparse.ArgumentParser(description='Scrape Paris real estate listings.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command, help_text in (('scrape', 'scrape new properties'),
+                               ('update', 'check existing properties for changes (BienIci only)'),
+                               ('publish', 'add new property urls to the shared crawl queue (BienIci only)'),
+                               ('work', 'scrape properties from the shared crawl queue (BienIci only)')):
+        command_parser = commands.add_parser(command, help=help_text)
+        command_parser.add_argument('site', choices=['bienici', 'seloger'] if command == 'scrape' else ['bienici'])
+        command_parser.add_argument('buy_or_rent', choices=['buy', 'rent'])
+    stats_parser = commands.add_parser('stats', help='export the price_stats table to a csv file')
+    stats_parser.add_argument('path', nargs='?', default='price_stats.csv')
+    commands.add_parser('rebuild-stats', help='recompute the price_stats table from the listing tables')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'stats':
+        export_stats(args.path)
+    elif args.command == 'rebuild-stats':
+        rebuild_stats()
+    else:
+        scraper = get_scraper(args.site, args.buy_or_rent)
+        getattr(scraper, {'scrape': 'scrape', 'update': 'update_table', 'publish': 'publish', 'work': 'work'}[args.command])()
 
 
 
@@ -55,4 +99,4 @@ if __name__ == '__main__':
 #     return df
 
 # rent = get_table('bien_ici_rent')
-# print(rent.tail())
\ No newline at end of file
+# print(rent.tail())
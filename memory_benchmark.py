@@ -0,0 +1,129 @@
+# This script checks that memory stays flat on long runs, by scraping thousands of generated BienIci & Seloger pages
+# through a fake browser into a temporary SQLite database.
+# Each site is run twice: with the page cache enabled (the default setup, cached in a temporary directory) and bypassed.
+# Usage: python memory_benchmark.py [index pages] [properties per page]
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import tracemalloc
+import settings
+
+GROWTH_LIMIT_MB = 1.0 # allowed difference between the memory in use early and late in the run
+# The set of urls already in the table, used to count duplicates, grows with the table and accounts for about 0.5MB at the default size.
+SAMPLE_EVERY = 250 # properties scraped between memory samples
+FILLER = '<div class="filler">' + 'Lorem ipsum dolor sit amet. ' * 1500 + '</div>' # real pages are mostly scripts & markup we don't use
+
+class FakeBrowser():
+    # Serves generated pages, implementing the parts of seleniumbase's SB the scrapers use. The site specific pages are built by the subclasses.
+    def __init__(self, properties_per_page:int) -> None:
+        self.properties_per_page = properties_per_page
+        self.current_url = ''
+        self.properties = 0 # properties served so far
+        self.samples = []
+
+    def _served(self, properties:int) -> None:
+        # takes a memory sample each time another SAMPLE_EVERY properties have been served
+        for _ in range((self.properties + properties) // SAMPLE_EVERY - self.properties // SAMPLE_EVERY):
+            self.samples.append(tracemalloc.get_traced_memory()[0])
+        self.properties += properties
+
+    def get(self, url:str) -> None:
+        self.current_url = url
+
+    def get_current_url(self) -> str:
+        return self.current_url
+
+    def wait_for_element_present(self, element:str, timeout:int = 10) -> None:
+        pass
+
+    def is_element_present(self, element:str) -> bool:
+        return True
+
+
+class BienIciBrowser(FakeBrowser):
+    # index pages link to one detail page per property
+    def get(self, url:str) -> None:
+        super().get(url)
+        if '/annonce/' in url:
+            self._served(1)
+
+    def get_page_source(self) -> str:
+        if '/annonce/' not in self.current_url:
+            page = int(self.current_url.rsplit('=', 1)[-1])
+            links = ''.join(f'<a class="detailedSheetLink" href="/annonce/vente/paris-11e/appartement/2pieces/agency-{page}-{x}?q=bench">tile</a>'
+                            for x in range(self.properties_per_page))
+            return f'<html><body>{links}{FILLER}</body></html>'
+        return f'''<html><body>
+            <div class="allDetails"><div>27,5 m²</div><div>2 pièces</div><div>1 chambre</div><div>1 salle de bain</div><div>3e étage (sur 6)</div></div>
+            <div class="agency-overview__info-name">Agence</div>
+            <span class="fullAddress">Paris 11e 75011</span>
+            <span class="ad-price__the-price">319 000 €</span>
+            <span class="ad-price__price-per-square-meter">11 600 €/m²</span>
+            {FILLER}</body></html>'''
+
+
+class SelogerBrowser(FakeBrowser):
+    # every property is read from its tile on the index page
+    def get(self, url:str) -> None:
+        super().get(url)
+        self._served(self.properties_per_page)
+
+    def get_page_source(self) -> str:
+        page = int(self.current_url.rsplit('=', 1)[-1])
+        tiles = ''.join(f'''<div class="sc-bvTASY byzQLE">
+            <a class="sc-bJHhxl ceSuox" href="/annonces/achat/appartement/paris-11eme-75/{page}{x:04d}.htm">tile</a>
+            <div class="jxkWqO">Appartement</div>
+            <ul><li>2 pièces</li><li>1 chambre</li><li>27,5 m²</li><li>Étage 3/6</li><li>Balcon</li><li>Ascenseur</li></ul>
+            <div class="ccntto">319 000 €</div><div class="eyLVpC">11 600 €/m²</div>
+            <div class="eqIQiZ">Paris 11ème (75011)</div></div>''' for x in range(self.properties_per_page))
+        return f'<html><body>{tiles}{FILLER}</body></html>'
+
+
+def run(site:str, index_pages:int, properties_per_page:int, use_cache:bool = True) -> int:
+    run_dir = tempfile.mkdtemp()
+    settings.storage_backend = 'sqlite'
+    settings.sqlite_path = os.path.join(run_dir, 'memory_benchmark.sqlite')
+    settings.page_cache_bypass = not use_cache
+    settings.page_cache_dir = os.path.join(run_dir, 'page_cache')
+    settings.property_page_limit = index_pages
+    settings.print_results = False
+    logging.disable(logging.INFO)
+
+    import StorageBackends
+    StorageBackends._backend = None # each run gets its own database
+    if site == 'bienici':
+        from BienIciScraper import BienIciBuy as Scraper
+        browser = BienIciBrowser(properties_per_page)
+    else:
+        from SelogerScraper import SelogerBuy as Scraper
+        browser = SelogerBrowser(properties_per_page)
+    import bs4, unidecode # the scrapers import these lazily, load them before tracing so the first run doesn't count them as memory in use
+
+    class BenchmarkScraper(Scraper):
+        def _open_browser(self):
+            return contextlib.nullcontext(browser)
+
+    tracemalloc.start()
+    BenchmarkScraper().scrape()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    samples = [sample / 1024 / 1024 for sample in browser.samples]
+    print(f"\n{site}, page cache {'enabled' if use_cache else 'bypassed'}:")
+    print(f'{browser.properties} properties scraped, peak traced memory {peak / 1024 / 1024:.1f}MB')
+    print('memory in use every {} properties (MB): {}'.format(SAMPLE_EVERY, ', '.join(f'{sample:.1f}' for sample in samples)))
+    if len(samples) < 4:
+        print('Not enough samples to judge growth, increase the number of pages.')
+        return 1
+    quarter = len(samples) // 4
+    growth = sum(samples[-quarter:]) / quarter - sum(samples[:quarter]) / quarter
+    print(f'growth between the first and last quarter of the run: {growth:.2f}MB (limit {GROWTH_LIMIT_MB}MB)')
+    return 0 if growth < GROWTH_LIMIT_MB else 1
+
+if __name__ == '__main__':
+    index_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    properties_per_page = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    results = [run(site, index_pages, properties_per_page, use_cache) for site in ('bienici', 'seloger') for use_cache in (True, False)]
+    sys.exit(max(results))
@@ -14,4 +14,80 @@ max_retry = 5
 print_results = False
 
 ## Demo mode slows the script down for you to inspect. Ensure headless = False if using demo_mode.
-demo_mode = False
\ No newline at end of file
+demo_mode = False
+
+## The page cache stores rendered pages on disk so parsers can be re-run without touching the network.
+## Set page_cache_bypass = True to always fetch pages from the website.
+page_cache_bypass = False
+page_cache_dir = '.page_cache'
+
+## Number of seconds a cached page stays fresh. Index pages change quickly, detail pages less so.
+page_cache_ttl = {
+    'index': 60 * 30,
+    'detail': 60 * 60 * 24,
+}
+
+## Maximum size of the page cache in megabytes. The least recently used pages are removed first.
+page_cache_max_mb = 500
+
+## Replay mode serves cached pages regardless of their age. Useful for re-running the parsers after fixing a selector.
+page_cache_replay = False
+
+## Location of the json file containing the css selectors for each website. It's re-read while the scraper runs,
+## so a selector can be fixed without restarting. Bump the 'version' number in the file when changing a selector.
+selector_config_path = 'selectors.json' # relative paths are relative to this folder, not the working directory
+
+## The parse monitor checks the share of recent properties where each field was found.
+## If a field drops below its threshold it's likely the website has changed its layout.
+parse_monitor_thresholds = {
+    'price': 0.8,
+    'monthly_rent': 0.8,
+    'size': 0.8,
+    'zip_code': 0.8,
+    'property_type': 0.8,
+}
+parse_monitor_window = 50 # number of recent properties considered
+parse_monitor_min_rows = 20 # number of properties required before checking
+
+## What to do when fill rates collapse:
+## 'halt' stops the scraper with an error.
+## 'degrade' logs an error, reloads the selector config and carries on.
+parse_monitor_action = 'halt'
+parse_monitor_dump_dir = 'failed_batches' # when halting, the unsaved batch is written here so the scraped rows aren't lost
+
+## Database the scraped data is stored in: 'mysql', 'sqlite' or 'duckdb'.
+## mysql requires a running server and the .env file, sqlite needs nothing extra and duckdb requires `pip install duckdb`.
+storage_backend = 'mysql'
+sqlite_path = 'paris_re.sqlite'
+duckdb_path = 'paris_re.duckdb'
+
+## Distributed mode: BienIci publish() adds property urls to a shared queue in the database and work() scrapes them.
+## Workers lease queue_batch_size urls at a time. If a lease isn't acked within queue_lease_seconds (e.g. the worker crashed),
+## the urls become available to other workers. Urls that fail queue_max_attempts times are given up on.
+queue_batch_size = 5
+queue_lease_seconds = 600
+queue_max_attempts = 3
+migration_lock_seconds = 300 # MySQL only, how long a worker waits for another to finish migrating the schema
+price_stats_lock_seconds = 60 # MySQL only, how long a worker waits for another to finish updating the price statistics
+
+## update_table re-checks the listings most likely to have changed first (see RefreshScheduler.py).
+## Maximum number of minutes of browser time spent per update_table run, 0 for no limit.
+refresh_budget_minutes = 60
+## Listings younger than this many days are treated as more volatile.
+refresh_young_listing_days = 30
+## A listing checked this many days ago is ~63% as urgent as one that was never checked.
+refresh_staleness_days = 7
+## Relative priority of each website.
+refresh_site_weights = {
+    'bienici': 1.0,
+    'seloger': 1.0,
+}
+## Relative priority by price segment: (upper bound, weight) pairs in increasing order, None for no upper bound.
+refresh_segment_weights = {
+    'buy': [(300000, 1.0), (1000000, 1.2), (None, 1.5)],
+    'rent': [(1000, 1.0), (2500, 1.2), (None, 1.5)],
+}
+
+## Maximum number of scraped properties held in memory before they're saved to the database.
+## Keeps memory flat on long runs, lower it to save more often.
+max_rows_in_flight = 25
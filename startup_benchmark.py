@@ -0,0 +1,48 @@
+# This script measures how long the imports of each command take, using python -X importtime.
+# Usage: python startup_benchmark.py
+import re
+import subprocess
+import sys
+import time
+import settings
+
+# The imports each command makes before doing any work.
+COMMANDS = {
+    'main (argument parsing only)': 'import main',
+    # get_backend() imports the database driver chosen in settings.py, as connecting does in the real command
+    'stats': 'import main, DataPipeline, StorageBackends; StorageBackends.get_backend()',
+    'scrape/update (scraper modules)': 'import main, BienIciScraper, SelogerScraper',
+    'scrape/update (browser & parsing libraries)': 'import seleniumbase, bs4, unidecode',
+    'retrieve_table (pandas & sqlalchemy)': 'import pandas, sqlalchemy',
+}
+TARGET_SECONDS = 1.0 # startup target for commands that don't need a browser
+
+def measure(statement:str) -> tuple:
+    # returns (wall clock seconds, {top level module: cumulative import microseconds}) or (None, error message)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    top_level = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line) # modules imported at the top level have no indentation
+        if match:
+            top_level[match.group(2)] = int(match.group(1))
+    return elapsed, top_level
+
+if __name__ == '__main__':
+    for command, statement in COMMANDS.items():
+        elapsed, details = measure(statement)
+        if elapsed is None:
+            print(f'{command}: not measured ({details})')
+            continue
+        slowest = sorted(details.items(), key=lambda item: item[1], reverse=True)[:5]
+        print(f'{command}: {elapsed:.3f}s wall clock')
+        for module, microseconds in slowest:
+            print(f'    {module}: {microseconds / 1000:.1f}ms')
+    stats_elapsed, _ = measure(COMMANDS['stats'])
+    if stats_elapsed is None:
+        print(f'\nNon-browser startup not measured, the {settings.storage_backend} driver could not be imported.')
+    else:
+        print(f"\nNon-browser startup {'meets' if stats_elapsed < TARGET_SECONDS else 'misses'} the {TARGET_SECONDS}s target ({stats_elapsed:.3f}s).")